@@ -0,0 +1,282 @@
+## Copyright (C) 2023, Nicholas Carlini <nicholas@carlini.com>.
+##
+## This program is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import sys
+import requests
+import requests.adapters
+from cassette import Cassette
+
+API_URL = "https://api.openai.com/v1/completions"
+LOCAL_URL = "http://127.0.0.1:8080/v1/completions"
+
+class RateLimited(Exception):
+    """The server answered 429; try again in `retry_after` seconds."""
+    def __init__(self, retry_after, message=""):
+        super().__init__(message or f"Rate limited; retry after {retry_after}s")
+        self.retry_after = retry_after
+
+def check_response(response):
+    if response.status_code == 429:
+        if 'retry-after-ms' in response.headers:
+            retry_after = float(response.headers['retry-after-ms']) / 1000
+        else:
+            retry_after = float(response.headers.get('retry-after', 1))
+        raise RateLimited(retry_after)
+    response.raise_for_status()
+
+class CompletionBackend:
+    """
+    Where ChessLLM gets its completions from. Pick one with "backend" in
+    config.json; see BACKENDS for the names.
+
+    complete() takes a list of prompts and returns one completion for each,
+    in order, at the configured temperature unless given another one.
+    complete_logprobs() does the same but also returns, for every
+    prompt, the completion's tokens with their log probabilities and the
+    `top_k` most likely tokens at each point (as in the OpenAI API's
+    `logprobs` field). score() generates nothing, and returns the log
+    probability of every token of each prompt instead. These three return
+    their results together with the request's `usage` (the prompt_tokens
+    and completion_tokens billed for it, as in the API's response), or
+    None where there is no bill. stream() yields the text of a single
+    completion as it is generated. All of them are blocking; ChessLLM runs
+    them on its thread pool, and passes a `timeout` in seconds when it will
+    stop waiting for the answer. complete() is also given the request's
+    `priority` (see scheduler.py), for a batch_proxy.py in between.
+    """
+    def __init__(self, api_key, config):
+        self.api_key = api_key
+        self.config = config
+
+    def prewarm(self):
+        pass
+
+    def complete(self, prompts, num_tokens, timeout=None, temperature=None, priority=None):
+        raise NotImplementedError
+
+    def complete_logprobs(self, prompts, num_tokens, top_k, timeout=None):
+        raise NotImplementedError(f"The {type(self).__name__} doesn't give log probabilities")
+
+    def score(self, prompts, timeout=None):
+        raise NotImplementedError(f"The {type(self).__name__} doesn't give log probabilities")
+
+    def stream(self, prompt, num_tokens, timeout=None):
+        yield from self.complete([prompt], num_tokens, timeout)[0]
+
+    def stats(self):
+        return {}
+
+    def close(self):
+        pass
+
+class OpenAIBackend(CompletionBackend):
+    """The legacy completions endpoint, or anything that speaks the same protocol."""
+    def __init__(self, api_key, config):
+        super().__init__(api_key, config)
+        self.url = config.get('api_url', API_URL)
+
+        # One keep-alive session per engine so that each move reuses an
+        # already open TLS connection instead of handshaking again. Every
+        # request in flight needs its own connection, or the pool would
+        # throw connections away and open new ones all the time.
+        pool_size = max(config.get('pool_size', 4), config.get('max_in_flight', 8))
+        self.timeout = (config.get('connect_timeout', 5), config.get('read_timeout', 30))
+        self.session = requests.Session()
+        self.session.headers.update(self.headers())
+        self.adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("https://", self.adapter)
+        self.session.mount("http://", self.adapter)
+
+    def headers(self):
+        return {
+            "Content-Type": "application/json",
+            "Authorization": f"Bearer {self.api_key}"
+        }
+
+    def prewarm(self):
+        # Any reply at all (even a 404) leaves an open connection in the pool.
+        try:
+            self.session.head(self.url, timeout=self.timeout)
+        except requests.RequestException as e:
+            print("Could not pre-warm connection:", e, file=sys.stderr)
+
+    def request_data(self, prompt, num_tokens, temperature=None):
+        return {
+            "model": self.config['model'],
+            "prompt": prompt,
+            "temperature": self.config['temperature'] if temperature is None else temperature,
+            "max_tokens": num_tokens,
+        }
+
+    def request_timeout(self, timeout):
+        if timeout is None:
+            return self.timeout
+        return (min(self.timeout[0], timeout), min(self.timeout[1], timeout))
+
+    def post(self, data, timeout, priority=None):
+        #sys.stderr.write(repr(data)+"\n")
+        # The API ignores these; batch_proxy.py schedules by them.
+        headers = {}
+        if priority is not None:
+            headers["X-Priority"] = str(priority)
+        if timeout is not None:
+            headers["X-Timeout"] = str(timeout)
+        response = self.session.post(self.url, data=json.dumps(data), headers=headers,
+                                     timeout=self.request_timeout(timeout))
+        check_response(response)
+        body = response.json()
+        return sorted(body['choices'], key=lambda choice: choice['index']), body.get('usage')
+
+    def complete(self, prompts, num_tokens, timeout=None, temperature=None, priority=None):
+        choices, usage = self.post(self.request_data(prompts, num_tokens, temperature), timeout, priority)
+        response = [choice['text'] for choice in choices]
+        #sys.stderr.write(repr(response)+"\n")
+
+        return response, usage
+
+    def complete_logprobs(self, prompts, num_tokens, top_k, timeout=None):
+        choices, usage = self.post(dict(self.request_data(prompts, num_tokens), logprobs=top_k), timeout)
+        return [(choice['text'], choice['logprobs']) for choice in choices], usage
+
+    def score(self, prompts, timeout=None):
+        data = dict(self.request_data(prompts, 0), echo=True, logprobs=0)
+        choices, usage = self.post(data, timeout)
+        return [choice['logprobs'] for choice in choices], usage
+
+    def stream(self, prompt, num_tokens, timeout=None):
+        data = dict(self.request_data(prompt, num_tokens), stream=True)
+
+        with self.session.post(self.url, data=json.dumps(data), timeout=self.request_timeout(timeout),
+                               stream=True) as response:
+            check_response(response)
+            for line in response.iter_lines(chunk_size=None):
+                if not line.startswith(b"data: "):
+                    continue
+                if line == b"data: [DONE]":
+                    break
+                yield json.loads(line[6:])['choices'][0]['text']
+
+    def close(self):
+        self.session.close()
+
+    def stats(self):
+        pools = self.adapter.poolmanager.pools
+        pools = [pools[key] for key in pools.keys()]
+        requests_made = sum(pool.num_requests for pool in pools)
+        connections = sum(pool.num_connections for pool in pools)
+        return {"requests": requests_made,
+                "connections_opened": connections,
+                "connections_reused": requests_made - connections}
+
+class LocalBackend(OpenAIBackend):
+    """The offline stand-in server in standin_server.py. No API key needed."""
+    def __init__(self, api_key, config):
+        super().__init__(api_key, dict(config, api_url=config.get('local_url', LOCAL_URL)))
+
+    def headers(self):
+        return {"Content-Type": "application/json"}
+
+class CassetteBackend(CompletionBackend):
+    """Replays completions recorded in `cassette_path`, without any network access."""
+    def __init__(self, api_key, config):
+        super().__init__(api_key, config)
+        self.cassette = Cassette(config['cassette_path'])
+        self.hits = 0
+        self.misses = 0
+
+    def complete(self, prompts, num_tokens, timeout=None, temperature=None, priority=None):
+        if temperature is None:
+            temperature = self.config['temperature']
+        out = []
+        for prompt in prompts:
+            key = Cassette.key(self.config['model'], temperature, num_tokens, prompt)
+            completion = self.cassette.get(key)
+            if completion is None:
+                self.misses += 1
+                raise KeyError(f"Prompt not in cassette {self.config['cassette_path']}: ...{prompt[-60:]!r}")
+            self.hits += 1
+            out.append(completion)
+        # Replaying costs nothing.
+        return out, None
+
+    def stats(self):
+        return {"cassette_hits": self.hits, "cassette_misses": self.misses}
+
+    def close(self):
+        self.cassette.close()
+
+class RecordingBackend(CompletionBackend):
+    """Passes requests on to another backend and records every completion to a cassette."""
+    def __init__(self, backend, cassette_path):
+        super().__init__(backend.api_key, backend.config)
+        self.backend = backend
+        self.cassette = Cassette(cassette_path)
+
+    def key(self, prompt, num_tokens, temperature=None):
+        if temperature is None:
+            temperature = self.config['temperature']
+        return Cassette.key(self.config['model'], temperature, num_tokens, prompt)
+
+    def prewarm(self):
+        self.backend.prewarm()
+
+    def complete(self, prompts, num_tokens, timeout=None, temperature=None, priority=None):
+        # At a temperature above 0 several prompts may be the same; the last
+        # sample of each is the one kept.
+        completions, usage = self.backend.complete(prompts, num_tokens, timeout, temperature, priority)
+        self.cassette.put([(self.key(prompt, num_tokens, temperature), completion)
+                           for prompt, completion in zip(prompts, completions)])
+        return completions, usage
+
+    def complete_logprobs(self, prompts, num_tokens, top_k, timeout=None):
+        # Cassettes only hold the text, so these aren't recorded.
+        return self.backend.complete_logprobs(prompts, num_tokens, top_k, timeout)
+
+    def score(self, prompts, timeout=None):
+        return self.backend.score(prompts, timeout)
+
+    def stream(self, prompt, num_tokens, timeout=None):
+        # ChessLLM stops reading once the line turns illegal. Whatever was
+        # read up to then is what gets recorded, which replays to the same moves.
+        chunks = []
+        try:
+            for chunk in self.backend.stream(prompt, num_tokens, timeout):
+                chunks.append(chunk)
+                yield chunk
+        finally:
+            self.cassette.put([(self.key(prompt, num_tokens), "".join(chunks))])
+
+    def stats(self):
+        return self.backend.stats()
+
+    def close(self):
+        self.backend.close()
+        self.cassette.close()
+
+BACKENDS = {
+    "openai": OpenAIBackend,
+    "local": LocalBackend,
+    "cassette": CassetteBackend,
+}
+
+def make_backend(api_key, config):
+    name = config.get('backend', "openai")
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown backend {name!r}; expected one of {', '.join(BACKENDS)}")
+    backend = BACKENDS[name](api_key, config)
+    if config.get('record_cassette'):
+        backend = RecordingBackend(backend, config['record_cassette'])
+    return backend
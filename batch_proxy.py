@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+
+## Copyright (C) 2023, Nicholas Carlini <nicholas@carlini.com>.
+##
+## This program is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# A local completions endpoint that batches requests from several processes.
+#
+# lichess-bot plays each game in its own process, so their requests can't
+# be batched inside ChessLLM. Run this proxy and point every game at it with
+# "api_url": "http://127.0.0.1:8000/v1/completions" in config.json; single
+# prompts that arrive within the window are forwarded upstream as one
+# request and each caller gets its own completion back.
+
+import argparse
+import asyncio
+import json
+import math
+import threading
+import requests
+import metrics
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from backends import API_URL, RateLimited, check_response
+from scheduler import RequestScheduler, NO_CLOCK
+from batcher import CompletionBatcher
+
+class BatchProxy:
+    def __init__(self, api_key, upstream, window, max_batch_size, max_in_flight):
+        self.upstream = upstream
+        self.session = requests.Session()
+        self.session.headers.update({
+            "Content-Type": "application/json",
+            "Authorization": f"Bearer {api_key}"
+        })
+        self.scheduler = RequestScheduler(max_in_flight)
+        self.batcher = CompletionBatcher(self.send, window, max_batch_size)
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever, daemon=True).start()
+
+    def complete(self, data, timeout=None, priority=NO_CLOCK):
+        prompt = data.pop('prompt')
+        key = json.dumps(data, sort_keys=True)
+        text, usage = asyncio.run_coroutine_threadsafe(self.submit(prompt, key, timeout, priority), self.loop).result()
+        return {"choices": [{"text": text, "index": 0}], "usage": usage}
+
+    async def submit(self, prompt, key, timeout, priority):
+        # The batcher hands each caller's trace its share of the batch's
+        # usage, which is what this caller is billed for.
+        trace = metrics.MoveTrace()
+        metrics.current_trace.set(trace)
+        text = await self.batcher.submit(prompt, key, timeout, priority)
+        usage = {name: trace.counts[name] for name in ("prompt_tokens", "completion_tokens")}
+        return text, dict(usage, total_tokens=sum(usage.values()))
+
+    async def send(self, prompts, key, timeout, priority):
+        async with self.scheduler.slot(priority):
+            loop = asyncio.get_running_loop()
+            texts, usage = await loop.run_in_executor(None, self.post, prompts, json.loads(key), timeout)
+        if usage is not None:
+            metrics.count("prompt_tokens", usage.get('prompt_tokens', 0))
+            metrics.count("completion_tokens", usage.get('completion_tokens', 0))
+        return texts
+
+    def post(self, prompts, params, timeout):
+        response = self.session.post(self.upstream, data=json.dumps(dict(params, prompt=prompts)), timeout=timeout)
+        # A 429 goes back to every caller in the batch, so that they back off.
+        check_response(response)
+        body = response.json()
+        choices = sorted(body['choices'], key=lambda choice: choice['index'])
+        return [choice['text'] for choice in choices], body.get('usage')
+
+def make_handler(proxy):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_HEAD(self):
+            self.send_response(200)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        def do_POST(self):
+            data = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+            # Only the text comes back from a batch, so anything asking for
+            # log probabilities has to go through as it is.
+            whole = data.get('logprobs') is not None or data.get('echo')
+            if not whole and isinstance(data.get('prompt'), list) and len(data['prompt']) == 1:
+                data['prompt'] = data['prompt'][0]
+            try:
+                if whole or data.get('stream') or not isinstance(data.get('prompt'), str):
+                    # Streams, log probabilities and requests that are
+                    # already batched go straight through.
+                    return self.forward(data)
+                # ChessLLM sends its request's clock priority and timeout
+                # along, so the batches keep them.
+                timeout = self.headers.get("X-Timeout")
+                self.reply(200, proxy.complete(data, None if timeout is None else float(timeout),
+                                               float(self.headers.get("X-Priority", NO_CLOCK))))
+            except RateLimited as e:
+                self.reply(429, {"error": {"message": str(e), "type": "requests"}},
+                           {"retry-after": str(math.ceil(e.retry_after)),
+                            "retry-after-ms": str(math.ceil(e.retry_after * 1000))})
+            except Exception as e:
+                self.reply(502, {"error": {"message": str(e)}})
+
+        def forward(self, data):
+            with proxy.session.post(proxy.upstream, data=json.dumps(data), stream=True) as response:
+                self.send_response(response.status_code)
+                self.send_header("Content-Type", response.headers.get("Content-Type", "application/json"))
+                for name in ("retry-after", "retry-after-ms"):
+                    if name in response.headers:
+                        self.send_header(name, response.headers[name])
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                for chunk in response.iter_content(chunk_size=None):
+                    self.wfile.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+                    self.wfile.flush()
+                self.wfile.write(b"0\r\n\r\n")
+
+        def reply(self, status, body, headers={}):
+            body = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+def main():
+    parser = argparse.ArgumentParser(description="Batch completion requests from several processes.")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--window-ms", type=float, default=20)
+    parser.add_argument("--max-batch-size", type=int, default=16)
+    parser.add_argument("--max-in-flight", type=int, default=8)
+    parser.add_argument("--upstream", default=API_URL)
+    args = parser.parse_args()
+
+    api_key = open("OPENAI_API_KEY").read().strip()
+    proxy = BatchProxy(api_key, args.upstream, args.window_ms / 1000, args.max_batch_size, args.max_in_flight)
+    print(f"Batching completions for {args.upstream} on port {args.port}")
+    ThreadingHTTPServer(("127.0.0.1", args.port), make_handler(proxy)).serve_forever()
+
+if __name__ == "__main__":
+    main()
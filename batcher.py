@@ -0,0 +1,109 @@
+## Copyright (C) 2023, Nicholas Carlini <nicholas@carlini.com>.
+##
+## This program is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import contextvars
+import metrics
+from scheduler import NO_CLOCK, on_dispatch
+
+class CompletionBatcher:
+    """
+    Gathers prompts that arrive within `window` seconds of each other and
+    sends them as one completion request with a list of prompts.
+
+    Prompts are only batched with others that share the same `key` (i.e.
+    the same request parameters). `send(prompts, key, timeout, priority)`
+    must return the completions in the same order as the prompts. A batch
+    goes out as soon as it is full, and never later than `window` after its
+    first prompt, so the added latency is at most `window`. It goes out at
+    the most urgent priority of its prompts, with the longest timeout (None
+    if any of them has none), so no caller waits longer than it would have
+    alone; each caller still gives up at its own timeout.
+
+    The request is sent outside of any caller's move trace. Each caller's
+    trace gets the whole time the request took, since every one of them
+    waited for it, and a share of the tokens it was billed for in
+    proportion to the length of its own prompt and completion. Their
+    scheduler.on_dispatch callbacks run when the batch gets its slot.
+    """
+    def __init__(self, send, window, max_batch_size):
+        self.send = send
+        self.window = window
+        self.max_batch_size = max_batch_size
+        self.pending = {}
+        self.batches_sent = 0
+        self.prompts_sent = 0
+
+    async def submit(self, prompt, key, timeout=None, priority=NO_CLOCK):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        batch = self.pending.setdefault(key, [])
+        batch.append((prompt, future, timeout, priority, (metrics.current_trace.get(), on_dispatch.get())))
+        # Tasks copy the context they are started from, so without a fresh
+        # one the batch would count towards the move that happened to start it.
+        if len(batch) == 1:
+            loop.call_later(self.window, lambda: loop.create_task(self.flush(key, batch)),
+                            context=contextvars.Context())
+        if len(batch) >= self.max_batch_size:
+            contextvars.Context().run(loop.create_task, self.flush(key, batch))
+        return await future
+
+    async def flush(self, key, batch):
+        # The window timer and the full-batch trigger can both fire for the
+        # same batch; only the first one sends it.
+        if self.pending.get(key) is not batch:
+            return
+        del self.pending[key]
+
+        self.batches_sent += 1
+        self.prompts_sent += len(batch)
+        timeouts = [timeout for _, _, timeout, _, _ in batch]
+        timeout = None if None in timeouts else max(timeouts)
+        priority = min(priority for _, _, _, priority, _ in batch)
+        prompts = [prompt for prompt, _, _, _, _ in batch]
+        trace = metrics.MoveTrace()
+        metrics.current_trace.set(trace)
+        callbacks = [callback for _, _, _, _, (_, callback) in batch if callback is not None]
+        def dispatched():
+            for callback in callbacks:
+                callback()
+        on_dispatch.set(dispatched)
+        try:
+            texts = await self.send(prompts, key, timeout, priority)
+        except Exception as e:
+            self.share(batch, trace, prompts, None)
+            for _, future, _, _, _ in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        self.share(batch, trace, prompts, texts)
+        for (_, future, _, _, _), text in zip(batch, texts):
+            if not future.done():
+                future.set_result(text)
+
+    def share(self, batch, trace, prompts, texts):
+        callers = [caller for _, _, _, _, (caller, _) in batch]
+        for caller in callers:
+            if caller is not None:
+                for name, seconds in trace.spans.items():
+                    caller.add_time(name, seconds)
+        shares = [("prompt_tokens", [len(prompt) for prompt in prompts])]
+        if texts is not None:
+            shares.append(("completion_tokens", [len(text) for text in texts]))
+        for name, lengths in shares:
+            if trace.counts[name] and sum(lengths):
+                for caller, length in zip(callers, lengths):
+                    if caller is not None:
+                        caller.counts[name] += round(trace.counts[name] * length / sum(lengths))
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+
+## Copyright (C) 2023, Nicholas Carlini <nicholas@carlini.com>.
+##
+## This program is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Microbenchmark for get_query_pgn: the per-move cost of building the prompt
+# by replaying the game with chess.pgn against the incremental PromptBuilder,
+# as the game gets longer. Also checks that both give the same prompt.
+#
+# ChessLLM hands the builder the history key it already computed for the
+# cache lookup; that key's own cost is shown separately, and is the only
+# part that still grows with the game.
+
+import random
+import time
+import chess
+import chess.pgn
+from history import history_key
+from prompt import PromptBuilder
+
+def replayed_movetext(board):
+    # What get_query_pgn used to do on every call.
+    pgn = str(chess.pgn.Game().from_board(board))
+    return pgn[:-1].strip().split("\n\n")[1] if board.move_stack else ""
+
+def random_game(plies, seed):
+    rng = random.Random(seed)
+    board = chess.Board()
+    while len(board.move_stack) < plies:
+        if board.outcome() is not None:
+            board = chess.Board()
+        board.push(rng.choice(list(board.legal_moves)))
+    return board
+
+def main():
+    games = 10
+    plies = 300
+    buckets = [0, 25, 50, 100, 150, 200, 250, 300]
+    replayed = [0.0] * len(buckets)
+    incremental = [0.0] * len(buckets)
+    keyed = [0.0] * len(buckets)
+    hashing = [0.0] * len(buckets)
+    counts = [0] * len(buckets)
+
+    for seed in range(games):
+        full = random_game(plies, seed)
+        builder = PromptBuilder()
+        keyed_builder = PromptBuilder()
+        board = chess.Board()
+        for move in full.move_stack:
+            board.push(move)
+            bucket = max(i for i, start in enumerate(buckets) if len(board.move_stack) >= start)
+
+            start = time.perf_counter()
+            expected = replayed_movetext(board)
+            replayed[bucket] += time.perf_counter() - start
+
+            # A fresh board each time, like the boards lichess-bot and the
+            # UCI engine hand us every move.
+            fresh = board.copy()
+            start = time.perf_counter()
+            got = builder.movetext(fresh)
+            incremental[bucket] += time.perf_counter() - start
+
+            fresh = board.copy()
+            start = time.perf_counter()
+            key = history_key(fresh.root().fen(), fresh.move_stack)
+            hashing[bucket] += time.perf_counter() - start
+            start = time.perf_counter()
+            got_keyed = keyed_builder.movetext(fresh, key)
+            keyed[bucket] += time.perf_counter() - start
+
+            assert got == expected, (got, expected)
+            assert got_keyed == expected, (got_keyed, expected)
+            counts[bucket] += 1
+
+    print(f"{'plies':>10} {'replay (us)':>12} {'incremental (us)':>17} {'with key (us)':>14} {'key (us)':>9}")
+    for i, start in enumerate(buckets):
+        if counts[i]:
+            end = buckets[i+1] if i+1 < len(buckets) else plies
+            print(f"{f'{start}-{end}':>10} {replayed[i] / counts[i] * 1e6:12.1f} {incremental[i] / counts[i] * 1e6:17.1f}"
+                  f" {keyed[i] / counts[i] * 1e6:14.1f} {hashing[i] / counts[i] * 1e6:9.1f}")
+
+if __name__ == "__main__":
+    main()
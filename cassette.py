@@ -0,0 +1,60 @@
+## Copyright (C) 2023, Nicholas Carlini <nicholas@carlini.com>.
+##
+## This program is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import hashlib
+import json
+import sqlite3
+import threading
+
+class Cassette:
+    """
+    Recorded prompt -> completion pairs, for replaying traffic offline.
+
+    Only a 16 byte hash of the request (model, temperature, max_tokens and
+    prompt) is stored next to each completion, in a sqlite table indexed on
+    that hash, so opening a cassette costs the same whether it has ten
+    entries or ten million.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS completions "
+                          "(key BLOB PRIMARY KEY, completion TEXT NOT NULL) WITHOUT ROWID")
+
+    @staticmethod
+    def key(model, temperature, num_tokens, prompt):
+        request = json.dumps([model, temperature, num_tokens, prompt])
+        return hashlib.sha256(request.encode()).digest()[:16]
+
+    def get(self, key):
+        with self.lock:
+            row = self.conn.execute("SELECT completion FROM completions WHERE key = ?", (key,)).fetchone()
+        return None if row is None else row[0]
+
+    def put(self, entries):
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            self.conn.executemany("INSERT OR REPLACE INTO completions VALUES (?, ?)", entries)
+            self.conn.execute("COMMIT")
+
+    def __len__(self):
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM completions").fetchone()[0]
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
@@ -15,128 +15,771 @@
 ## You should have received a copy of the GNU General Public License
 ## along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import requests
-import json
+import asyncio
+import concurrent.futures
 
 import os
 import chess
 import chess.engine
 import chess.pgn
+import chess.polyglot
 import random
-import pickle
 import sys
+import threading
+import time
+import functools
+import collections
+import localsearch
+from contextlib import closing
+from movecache import MoveCache
+from movetable import MoveTable, encode_move, decode_move
+from history import history_key, history_keys, table_key
+from distribution import move_distribution
+from scheduler import RequestScheduler, NO_CLOCK
+from batcher import CompletionBatcher
+from backends import make_backend, RateLimited
+from prompt import PromptBuilder
+from ponder import Ponderer
+from singleflight import SingleFlight
+from ratelimit import RateLimiter
+import metrics
+from metrics import Histogram, MoveMetrics
+
+# How many times a request is sent again after a 429 before giving up.
+RATE_LIMIT_RETRIES = 5
+
+# Don't hedge on a latency percentile until it is based on this many requests.
+HEDGE_MIN_SAMPLES = 20
+
+class MoveStreamParser:
+    """
+    Parses SAN moves out of a completion as it arrives, with the same rules
+    as try_moves: tokens containing a '.' are skipped and the first token
+    that isn't a legal move ends the line.
+    """
+    def __init__(self, board):
+        self.board = board.copy()
+        self.moves = []
+        self.pending = ""
+        self.done = False
+
+    def feed(self, text):
+        # A token is only complete once we've seen the whitespace after it
+        # (otherwise "e8" might still turn into "e8=Q").
+        self.pending += text
+        tokens = self.pending.split()
+        if self.pending and not self.pending[-1].isspace():
+            self.pending = tokens.pop() if tokens else ""
+        else:
+            self.pending = ""
+        for token in tokens:
+            self.push(token)
+
+    def finish(self):
+        if self.pending:
+            self.push(self.pending)
+            self.pending = ""
+
+    def push(self, token):
+        if self.done or '.' in token:
+            return
+        try:
+            self.board.push_san(token)
+            self.moves.append(token)
+        except ValueError:
+            self.done = True
 
 class ChessLLM:
     def __init__(self, api_key, config, **override):
         self.config = config
         for k,v in override.items():
             config[k] = v
-        if os.path.exists("cache.p"):
-            with open("cache.p", "rb") as f:
-                self.cache = pickle.load(f)
-        else:
-            self.cache = {}
+        # Relative cache paths are taken from this directory so the UCI
+        # engine, the puzzle solver and every lichess-bot game share one file.
+        here = os.path.dirname(os.path.abspath(__file__))
+        cache_path = os.path.join(here, config.get('cache_path', "cache.db"))
+        # The old pickle was written to whatever directory we were run from,
+        # which for lichess-bot was its own.
+        legacy_paths = [os.path.join(os.path.dirname(cache_path), "cache.p"),
+                        os.path.join(here, "lichess-bot", "cache.p"),
+                        os.path.abspath("cache.p")]
+        self.cache = MoveCache(cache_path, list(dict.fromkeys(legacy_paths)))
         print("Loading cache with", len(self.cache), "entries")
+        legacy = self.cache.legacy_count()
+        if legacy and not config.get('transposition_fallback', False):
+            sys.stderr.write(f"{legacy} positions from an old cache.p are only used with transposition_fallback on\n")
+        # Hot entries are also kept in memory: replies by move history, and
+        # (only if transposition_fallback is on) positions by Zobrist hash.
+        # See lookup.
+        self.history = MoveTable(config.get('history_table_capacity', 1 << 18))
+        self.table = None
+        if config.get('transposition_fallback', False):
+            self.table = MoveTable(config.get('move_table_capacity', 1 << 18))
         self.api_key = api_key
+        self.backend = make_backend(api_key, config)
+        self.backend.prewarm()
+        self.prompts = PromptBuilder()
 
-    def get_query_pgn(self, board):
-        pgn = str(chess.pgn.Game().from_board(board))
+        # All requests run on a private event loop in a background thread.
+        # The async API hands coroutines to it and the sync API blocks on
+        # them, so both share one scheduler and one in-flight limit.
+        max_in_flight = config.get('max_in_flight', 8)
+        self.scheduler = RequestScheduler(max_in_flight)
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_in_flight)
+        self.background = set()
+        self.batcher = None
+        if config.get('batch_window_ms', 0) > 0:
+            self.batcher = CompletionBatcher(self.request_completions,
+                                             config['batch_window_ms'] / 1000,
+                                             config.get('max_batch_size', 16))
+        # Shared with every other process using the same cache file, since
+        # they all spend the same API key's limits.
+        self.limiter = None
+        if config.get('rate_limit_rpm', 0) or config.get('rate_limit_tpm', 0):
+            self.limiter = RateLimiter(cache_path, config.get('rate_limit_rpm', 0), config.get('rate_limit_tpm', 0))
+        # Timings and token counts of every move; see metrics_summary.
+        metrics_path = config.get('metrics_path')
+        self.metrics = MoveMetrics(os.path.join(here, metrics_path) if metrics_path else None)
+        # Request latencies by num_tokens, for hedging.
+        self.latency = collections.defaultdict(Histogram)
+        self.hedges_sent = 0
+        self.hedges_won = 0
+        self.singleflight = SingleFlight(self.cache, config.get('connect_timeout', 5) + config.get('read_timeout', 30))
+        self.ponderer = Ponderer(self, config.get('ponder_moves', 3), config.get('ponder_token_budget', 0))
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
 
-        if board.outcome() is None:
-            pgn = pgn[:-1].strip()
-        else:
+    def close(self):
+        # Cancel whatever is still running on the loop (pondering, streams
+        # being read to the end, batches, single-flight queries), stop the
+        # loop and let go of its thread, the thread pool and every connection.
+        # The engine can't be used afterwards.
+        if self.loop.is_closed():
+            return
+
+        async def cancel():
+            self.ponderer.stop()
+            tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+        self.run(cancel())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+        # A request already sent can't be interrupted; its thread exits once it returns.
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.backend.close()
+        if self.limiter is not None:
+            self.limiter.close()
+        self.cache.close()
+
+    def connection_stats(self):
+        stats = self.backend.stats()
+        if self.limiter is not None:
+            stats.update(self.limiter.stats())
+        stats.update(in_flight=self.scheduler.in_flight, waiting_for_slot=self.scheduler.waiting,
+                     hedges_sent=self.hedges_sent, hedges_won=self.hedges_won)
+        return stats
+
+    def metrics_summary(self):
+        return dict(self.metrics.summary(), history_table_entries=len(self.history),
+                    move_table_entries=0 if self.table is None else len(self.table), **self.connection_stats())
+
+    def cached_move(self, board):
+        return self.lookup(board)[0]
+
+    def lookup(self, board, key=None):
+        """
+        The cached move for `board` and where it came from: "history" if the
+        model has answered this exact game before (same start, same moves,
+        so the same prompt), or, with transposition_fallback on, "position"
+        if it answered some other game that reached the same position.
+        (None, None) if neither.
+
+        Each tier is looked up in memory first, then in the cache file,
+        which other processes may have added to since. `key` is the board's
+        history_key, if the caller already has it.
+        """
+        if key is None:
+            key = history_key(board.root().fen(), board.move_stack)
+        code = self.history.get(table_key(key))
+        if code is not None:
+            move = decode_move(code)
+            # Never return an illegal move, even after a (very unlikely) collision.
+            if board.is_legal(move):
+                return board.san(move), "history"
+        out = self.cache.get_reply(key)
+        if out is not None:
+            self.history.put(table_key(key), encode_move(board.parse_san(out)))
+            return out, "history"
+        if self.table is None:
+            return None, None
+
+        key = chess.polyglot.zobrist_hash(board)
+        code = self.table.get(key)
+        if code is not None:
+            move = decode_move(code)
+            # Hash collisions are very unlikely, but never return an illegal move.
+            if board.is_legal(move):
+                return board.san(move), "position"
+        out = self.cache.get(board.epd())
+        if out is not None:
+            self.table.put(key, encode_move(board.parse_san(out)))
+            return out, "position"
+        return None, None
+
+    def get_query_pgn(self, board, key=None):
+        if board.outcome() is not None:
             print("Game is over; no moves valid")
             return None
 
+        # Same text as the movetext of str(chess.pgn.Game().from_board(board)),
+        # without replaying the whole game every move. `key` is the board's
+        # history_key, if the caller already has it.
+        pgn = self.prompts.movetext(board, key)
+
         if board.turn == chess.WHITE:
             if board.fullmove_number == 1:
-                pgn = pgn + "\n\n1."
+                if pgn == "":
+                    pgn = "1."
             else:
                 pgn += ' '+str(board.fullmove_number)+"."
 
-        with_header = f"""[White "Magnus Carlsen"]\n[Black "Garry Kasparov"]\n[WhiteElo "2900"]\n[BlackElo "2800"]\n\n"""+pgn.split("\n\n")[1]
+        with_header = f"""[White "Magnus Carlsen"]\n[Black "Garry Kasparov"]\n[WhiteElo "2900"]\n[BlackElo "2800"]\n\n"""+pgn
 
         return with_header
 
     def try_moves(self, board, next_text):
-        board = board.copy()
-        moves = next_text.split()
-        ok_moves = []
+        parser = MoveStreamParser(board)
+        parser.feed(next_text)
+        parser.finish()
+        return parser.moves
+
+    def store_moves(self, board, moves):
+        # Each move of the predicted line is stored under the history that
+        # leads to it, and under its position for transposition_fallback.
+        root_fen = board.root().fen()
+        n = len(board.move_stack)
+        new_board = board.copy()
+        positions = {}
         for move in moves:
-            if '.' in move:
-                continue
-            try:
-                board.push_san(move)
-                ok_moves.append(move)
-            except:
-                break
+            parsed = new_board.parse_san(move)
+            positions[new_board.epd()] = move
+            if self.table is not None:
+                self.table.put(chess.polyglot.zobrist_hash(new_board), encode_move(parsed))
+            new_board.push(parsed)
+        keys = history_keys(root_fen, new_board.move_stack)[n:]
+        replies = {}
+        for key, move, parsed in zip(keys, moves, new_board.move_stack[n:]):
+            self.history.put(table_key(key), encode_move(parsed))
+            replies[key] = move
 
-        return ok_moves
+        self.cache.update_replies(replies)
+        self.cache.update(positions)
     
-    def get_best_move(self, board, num_tokens=None, conversation=None):
+    def run(self, coro):
+        # Run a coroutine on the engine's event loop and block until it is done.
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    def on_loop(self, coro):
+        # Same, but awaitable from any other event loop.
+        return asyncio.wrap_future(asyncio.run_coroutine_threadsafe(coro, self.loop))
+
+    def ponder(self, board, num_tokens=None):
+        # Start speculative queries for the opponent's likely replies to
+        # `board` and return right away; see Ponderer.
+        if num_tokens is None:
+            num_tokens = self.config['num_lookahead_tokens']
+        self.run(self.ponderer.start(board.copy(), num_tokens))
+
+    def new_game(self):
+        self.loop.call_soon_threadsafe(self.ponderer.new_game)
+
+    def get_best_move(self, board, num_tokens=None, conversation=None, time_budget=None, clock=None):
+        return self.run(self.find_best_move(board, num_tokens, conversation, time_budget, clock))
+
+    async def get_best_move_async(self, board, num_tokens=None, conversation=None, time_budget=None, clock=None):
+        return await self.on_loop(self.find_best_move(board, num_tokens, conversation, time_budget, clock))
+
+    async def find_best_move(self, board, num_tokens=None, conversation=None, time_budget=None, clock=None):
+        """
+        Get the model's move (in SAN) for `board`.
+
+        Without a `time_budget` this waits for the model however long it
+        takes and returns None if its reply isn't a legal move. With a
+        budget (in seconds) it always returns a move in time: if the model
+        hasn't answered legally by the time only the reserve for the local
+        fallback is left, the request is cancelled and fallback_move plays.
+
+        `clock` is the time left on our clock in seconds, if there is one.
+        Requests from games with less time left are sent first.
+
+        With blunder_check set, the move is then checked by a short local
+        search (see verify_move) before it is returned.
+        """
+        fen = board.fen()
+        trace = metrics.MoveTrace()
+        token = metrics.current_trace.set(trace)
+        try:
+            move = await self.choose_move(board, num_tokens, conversation, time_budget, clock, trace)
+            if move is not None and trace.outcome != "fallback" and self.config.get('blunder_check', False):
+                with trace.span("verification"):
+                    move = self.verify_move(board, move, conversation, trace)
+            return move
+        finally:
+            metrics.current_trace.reset(token)
+            self.metrics.record(trace, fen)
+
+    async def choose_move(self, board, num_tokens, conversation, time_budget, clock, trace):
         if num_tokens is None:
             num_tokens = self.config['num_lookahead_tokens']
         assert num_tokens >= 9, "A single move might take as many as 9 tokens (3 for the number + 6 for, e.g., 'N3xg5+)."
 
-        if board.fen() in self.cache:
-            out = self.cache[board.fen()]
+        self.ponderer.stop(keep=board.fen())
+        with trace.span("cache_lookup"):
+            key = history_key(board.root().fen(), board.move_stack)
+            out, tier = self.lookup(board, key)
+        trace.counts["history_hits" if tier == "history" else "history_misses"] += 1
+        if tier != "history" and self.config.get('transposition_fallback', False):
+            trace.counts["position_hits" if tier == "position" else "position_misses"] += 1
+        if out is not None:
+            trace.outcome = "cache"
+            self.cache.hit(board.epd())
             if conversation:
                 if board.ply() > 0:
                     conversation.send_message("player", f"You played a move already in my cache (because I predicted it or someone already played it)! Returning {out}.")
                     conversation.send_message("spectator", f"Player played a move already in my cache (because I predicted it or someone already played it). Returning {out}.")
             return out
 
-        pgn_to_query = self.get_query_pgn(board)
+        with trace.span("prompt_build"):
+            pgn_to_query = self.get_query_pgn(board, key)
 
         if conversation:
             conversation.send_message("player", f"Querying {self.config['model']} with ... {pgn_to_query.split(']')[-1][-90:]}")
             conversation.send_message("spectator", f"Querying {self.config['model']} with ... {pgn_to_query.split(']')[-1][-90:]}")
         
-        next_text = self.make_request(pgn_to_query, num_tokens)
-        if next_text[:2] == "-O":
-            next_text = self.make_request(pgn_to_query+" ", num_tokens)
+        priority = NO_CLOCK if clock is None else clock
+        samples = self.vote_samples(clock)
+        if samples > 1:
+            query = functools.partial(self.vote_moves, board, pgn_to_query, num_tokens, samples)
+        else:
+            query = functools.partial(self.query_moves, board, pgn_to_query, num_tokens)
+        deadline = None
+        if time_budget is None:
+            next_text, next_moves = await query(priority=priority)
+        else:
+            # Leave enough time for the fallback search (or the blunder
+            # check), plus a little slack.
+            reserve = self.config.get('fallback_time', 0.05) + 0.05
+            if self.config.get('blunder_check', False):
+                reserve = max(reserve, self.config.get('blunder_check_time', 0.05) + 0.05)
+            timeout = max(0, time_budget - reserve)
+            deadline = time.monotonic() + timeout
+            try:
+                next_text, next_moves = await asyncio.wait_for(query(timeout, priority), timeout)
+            except Exception as e:
+                # Timeouts, but also network errors and error replies: with a
+                # clock running, any move beats no move.
+                print(f"No reply from the model in {timeout:.2f}s ({e!r}); using the fallback", file=sys.stderr)
+                trace.counts["failed_requests"] += 1
+                next_text, next_moves = None, []
+        if next_text is not None and len(next_moves) == 0:
+            trace.counts["illegal_replies"] += 1
 
-        if conversation:
+        if conversation and next_text is not None:
             conversation.send_message("spectator", f"Received reply of '{next_text}'")
 
-        next_moves = self.try_moves(board, next_text)
+        if len(next_moves) == 0 and next_text is not None and self.config.get('score_legal_moves', False):
+            # Rather than give up on an illegal reply, have the model rank
+            # the legal moves, in whatever time is left.
+            with trace.span("scoring"):
+                try:
+                    timeout = None if deadline is None else max(0, deadline - time.monotonic())
+                    scores = await asyncio.wait_for(self.score_legal_moves(board, timeout, priority), timeout)
+                except Exception as e:
+                    print(f"Could not score the legal moves ({e!r})", file=sys.stderr)
+                    trace.counts["failed_requests"] += 1
+                    scores = []
+            if scores:
+                trace.outcome = "scored"
+                if conversation:
+                    conversation.send_message("spectator", f"Reply was illegal; playing {scores[0][0]}, the legal move the model likes best.")
+                return scores[0][0]
 
         if len(next_moves) == 0:
-            conversation.send_message("player", f"Tried to make an invalid move.")
-            conversation.send_message("spectator", f"Tried to make an invalid move.")
-            return None
+            if conversation:
+                conversation.send_message("player", f"Tried to make an invalid move.")
+                conversation.send_message("spectator", f"Tried to make an invalid move.")
+            if time_budget is None:
+                trace.outcome = "none"
+                return None
+            with trace.span("fallback"):
+                out = self.fallback_move(board)
+            trace.outcome = "fallback"
+            if conversation:
+                conversation.send_message("spectator", f"Playing {out} from the local fallback instead.")
+            return out
 
         if conversation:
             conversation.send_message("player", f"Received reply and making move {next_moves[0]}.")
-        
-        new_board = board.copy()
-        for move in next_moves:
-            self.cache[new_board.fen()] = move
-            new_board.push_san(move)
 
-        with open("cache.p", "wb") as f:
-            pickle.dump(self.cache, f)
+        trace.outcome = "model"
         return next_moves[0]
 
+    def vote_samples(self, clock):
+        # Fewer samples the less time there is: one per vote_seconds_per_sample on the clock.
+        most = self.config.get('vote_samples', 0)
+        if clock is None:
+            return most
+        return min(most, int(clock / self.config.get('vote_seconds_per_sample', 20)))
+
+    async def vote_moves(self, board, pgn_to_query, num_tokens, samples, timeout=None, priority=NO_CLOCK):
+        """
+        Self-consistency voting: sample up to `samples` completions at
+        vote_temperature and play the first move most of them agree on.
+        Returns (text, moves) like query_moves, for the longest legal line
+        starting with that move.
+
+        Samples are drawn in rounds of one batched request, each just big
+        enough for the leading move to reach a majority of `samples`, and
+        voting stops as soon as one does. Otherwise the move with the most
+        weight wins, where each sample weighs as many moves as its legal
+        line is long, so samples that stay sensible for longer count more.
+        """
+        temperature = self.config.get('vote_temperature', 0.7)
+        majority = samples // 2 + 1
+        votes = collections.Counter()
+        weights = collections.Counter()
+        lines = {}
+        texts = []
+        while len(texts) < samples:
+            leader = max(votes.values(), default=0)
+            if leader >= majority:
+                break
+            batch = await self.request_completions([pgn_to_query] * min(samples - len(texts), majority - leader),
+                                                   num_tokens, timeout, priority, temperature=temperature)
+            texts += batch
+            for text in batch:
+                moves = self.try_moves(board, text)
+                if not moves:
+                    continue
+                votes[moves[0]] += 1
+                weights[moves[0]] += len(moves)
+                if len(moves) > len(lines.get(moves[0], (None, []))[1]):
+                    lines[moves[0]] = (text, moves)
+        metrics.count("vote_samples", len(texts))
+        if not votes:
+            return texts[-1], []
+
+        winner, count = votes.most_common(1)[0]
+        if count < majority:
+            winner = max(weights, key=weights.get)
+        text, moves = lines[winner]
+        # The rest of the line is only one sample, so unlike query_moves
+        # only the voted move goes in the cache.
+        self.store_moves(board, moves[:1])
+        return text, moves
+
+    def get_move_distribution(self, board, top_k=5, num_tokens=8, clock=None):
+        return self.run(self.find_move_distribution(board, top_k, num_tokens, clock))
+
+    async def get_move_distribution_async(self, board, top_k=5, num_tokens=8, clock=None):
+        return await self.on_loop(self.find_move_distribution(board, top_k, num_tokens, clock))
+
+    async def find_move_distribution(self, board, top_k=5, num_tokens=8, clock=None):
+        """
+        The model's probabilities for the next move in `board` as
+        [(san, probability)], most likely first, from a single completion
+        request for the `top_k` most likely tokens at each step (the OpenAI
+        API allows at most 5). Only the first move's tokens matter, so
+        `num_tokens` only needs to cover one move. [] if the game is over.
+        """
+        pgn_to_query = self.get_query_pgn(board)
+        if pgn_to_query is None:
+            return []
+        priority = NO_CLOCK if clock is None else clock
+        text, logprobs = (await self.request_completions([pgn_to_query], num_tokens, priority=priority,
+                                                         logprobs=top_k))[0]
+        # The completion itself is the model's usual answer; keep it.
+        moves = self.try_moves(board, text)
+        if moves:
+            self.store_moves(board, moves)
+        return move_distribution(board, logprobs)
+
+    def get_move_scores(self, board, timeout=None, clock=None):
+        return self.run(self.score_legal_moves(board, timeout, NO_CLOCK if clock is None else clock))
+
+    async def score_legal_moves(self, board, timeout=None, priority=NO_CLOCK):
+        """
+        Every legal move in `board` as (san, log probability), most likely
+        first. Nothing is generated: the model is shown the prompt followed
+        by each legal move in turn and asked how likely each was, so this
+        always gives a legal move. The prompts go out in batches of up to
+        max_batch_size, all at once.
+        """
+        pgn_to_query = self.get_query_pgn(board)
+        if pgn_to_query is None:
+            return []
+        sans = [board.san(move) for move in board.legal_moves]
+        prompts = [pgn_to_query + " " + san for san in sans]
+        size = self.config.get('max_batch_size', 16)
+        batches = await asyncio.gather(*[self.request_completions(prompts[i:i+size], 0, timeout, priority, echo=True)
+                                         for i in range(0, len(prompts), size)])
+        scores = []
+        for san, logprobs in zip(sans, [logprobs for batch in batches for logprobs in batch]):
+            # The move is every token that ends past the end of the game so far.
+            scores.append((san, sum(logprob or 0 for token, logprob, offset
+                                    in zip(logprobs['tokens'], logprobs['token_logprobs'], logprobs['text_offset'])
+                                    if offset + len(token) > len(pgn_to_query))))
+        return sorted(scores, key=lambda score: -score[1])
+
+    async def query_moves(self, board, pgn_to_query, num_tokens, timeout=None, priority=NO_CLOCK):
+        pondered = self.ponderer.pending(board.fen())
+        if pondered is not None and self.ponderer.sent(board.fen()):
+            # We already asked while pondering and the answer is on its way.
+            try:
+                return await asyncio.shield(pondered)
+            except Exception:
+                pass
+        elif pondered is not None:
+            # Still waiting in line at speculative priority; ask at ours instead.
+            pondered.cancel()
+        # Other games (here or in other processes) may be asking about the
+        # same game right now; if so, wait for their answer instead. The
+        # query may outlive this call, so it gets its own copy of the board.
+        board = board.copy()
+        key = history_key(board.root().fen(), board.move_stack)
+        return await self.singleflight.run(
+            key, lambda: self.request_moves(board, pgn_to_query, num_tokens, timeout, priority))
+
+    async def request_moves(self, board, pgn_to_query, num_tokens, timeout=None, priority=NO_CLOCK):
+        if self.config.get('stream', False):
+            return await self.stream_moves(board, pgn_to_query, num_tokens, timeout, priority)
+
+        next_text = await self.request_completion(pgn_to_query, num_tokens, timeout, priority)
+        if next_text[:2] == "-O":
+            next_text = await self.request_completion(pgn_to_query+" ", num_tokens, timeout, priority)
+        with metrics.span("san_validation"):
+            next_moves = self.try_moves(board, next_text)
+        with metrics.span("cache_persist"):
+            self.store_moves(board, next_moves)
+        return next_text, next_moves
+
+    def verify_move(self, board, san, conversation=None, trace=None):
+        # Play something else if a search of blunder_check_depth plies (plus
+        # captures) finds a move more than blunder_margin centipawns better.
+        # The search stops after blunder_check_time seconds, and if it
+        # hasn't found anything by then the model's move stands.
+        refutation = localsearch.refute(board, board.parse_san(san), self.config.get('blunder_margin', 200),
+                                        self.config.get('blunder_check_time', 0.05),
+                                        self.config.get('blunder_check_depth', 2))
+        metrics.count("verified_moves", trace=trace)
+        if refutation is None:
+            return san
+        move, loss = refutation
+        metrics.count("blunders_replaced", trace=trace)
+        out = board.san(move)
+        print(f"{san} looks like a blunder ({loss} centipawns worse than {out}); playing {out} instead", file=sys.stderr)
+        if conversation:
+            conversation.send_message("spectator", f"{san} looks like it loses {loss} centipawns; playing {out} instead.")
+        return out
+
+    def fallback_move(self, board):
+        # Cached continuations were already tried, so: the opening book if
+        # there is one, then a very short local search.
+        book = self.config.get('fallback_book')
+        if book:
+            with chess.polyglot.open_reader(book) as reader:
+                entry = reader.get(board)
+            if entry is not None:
+                return board.san(entry.move)
+        move = localsearch.best_move(board, self.config.get('fallback_time', 0.05))
+        return None if move is None else board.san(move)
+
+    async def stream_moves(self, board, pgn_to_query, num_tokens, timeout=None, priority=NO_CLOCK):
+        # Return as soon as the first legal move has been parsed. The rest of
+        # the completion is read in the background and the whole predicted
+        # line goes into the cache once it is done. The caller may keep
+        # playing on its board in the meantime, so work on a copy.
+        board = board.copy()
+        loop = asyncio.get_running_loop()
+        first_move = asyncio.Event()
+        reply = {'text': "", 'parser': MoveStreamParser(board)}
+        trace = metrics.current_trace.get()
+
+        def read():
+            # Only time this move's trace until the first move is in; after
+            # that the trace may already have been recorded. Like everything
+            # else touching the trace, that happens on the event loop.
+            timing = trace is not None
+            start = time.monotonic()
+            try:
+                for prompt in (pgn_to_query, pgn_to_query+" "):
+                    parser = reply['parser'] = MoveStreamParser(board)
+                    reply['text'] = ""
+                    with closing(self.backend.stream(prompt, num_tokens, timeout)) as chunks:
+                        for chunk in chunks:
+                            if timing and not reply['text']:
+                                loop.call_soon_threadsafe(trace.add_time, "network", time.monotonic() - start)
+                                start = time.monotonic()
+                            reply['text'] += chunk
+                            if reply['text'][:2] == "-O" or parser.done or reply.get('cancelled'):
+                                break
+                            parser.feed(chunk)
+                            if parser.moves:
+                                if timing:
+                                    loop.call_soon_threadsafe(trace.add_time, "generation", time.monotonic() - start)
+                                    timing = False
+                                loop.call_soon_threadsafe(first_move.set)
+                    if reply['text'][:2] != "-O":
+                        break
+                parser.finish()
+                self.store_moves(board, parser.moves)
+            except Exception as e:
+                reply['error'] = e
+
+        async def read_in_slot():
+            try:
+                for attempt in range(RATE_LIMIT_RETRIES):
+                    start = time.monotonic()
+                    await self.wait_for_rate_limit([pgn_to_query], num_tokens, priority)
+                    async with self.scheduler.slot(priority):
+                        metrics.add_time("queue", time.monotonic() - start)
+                        await loop.run_in_executor(self.executor, read)
+                    error = reply.get('error')
+                    if not isinstance(error, RateLimited) or self.limiter is None or attempt == RATE_LIMIT_RETRIES-1:
+                        break
+                    self.limiter.backoff(error.retry_after)
+                    del reply['error']
+            finally:
+                first_move.set()
+
+        task = loop.create_task(read_in_slot())
+        self.background.add(task)
+        task.add_done_callback(self.background.discard)
+        try:
+            await first_move.wait()
+        except asyncio.CancelledError:
+            # Out of time: stop reading at the next chunk.
+            reply['cancelled'] = True
+            raise
+
+        next_moves = list(reply['parser'].moves)
+        if len(next_moves) == 0 and 'error' in reply:
+            raise reply['error']
+        # Streams don't report their usage, so estimate it (roughly four
+        # characters to a token) from what has been read so far.
+        metrics.count("prompt_tokens", len(pgn_to_query) // 4)
+        metrics.count("completion_tokens", len(reply['text']) // 4)
+        return reply['text'], next_moves
+
     def make_request(self, content, num_tokens):
-        url = "https://api.openai.com/v1/completions"
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {self.api_key}"
-        }
-        data = {
-            "model": self.config['model'],
-            "prompt": content,
-            "temperature": self.config['temperature'],
-            "max_tokens": num_tokens,
-        }
-    
+        return self.run(self.request_completion(content, num_tokens))
 
-        #sys.stderr.write(repr(data)+"\n")
-        response = requests.post(url, headers=headers, data=json.dumps(data))
-        response = response.json()['choices'][0]['text']
-        #sys.stderr.write(response+"\n")
+    async def make_request_async(self, content, num_tokens):
+        return await self.on_loop(self.request_completion(content, num_tokens))
 
-        return response
-    
+    async def request_completion(self, content, num_tokens, timeout=None, priority=NO_CLOCK):
+        # With batching on, prompts from concurrent callers that arrive
+        # within batch_window_ms of each other share a single request.
+        if self.batcher is not None:
+            return await self.batcher.submit(content, num_tokens, timeout, priority)
+        return (await self.request_completions([content], num_tokens, timeout, priority))[0]
+
+    async def wait_for_rate_limit(self, prompts, num_tokens, priority):
+        if self.limiter is not None:
+            # Roughly four characters to a token.
+            await self.limiter.acquire(sum(len(prompt) // 4 + num_tokens for prompt in prompts), priority)
+
+    def hedge_delay(self, num_tokens):
+        percentile = self.config.get('hedge_percentile', 0)
+        histogram = self.latency[num_tokens]
+        if not percentile or histogram.total < HEDGE_MIN_SAMPLES:
+            return None
+        return histogram.percentile(percentile)
 
+    async def request_completions(self, prompts, num_tokens, timeout=None, priority=NO_CLOCK, logprobs=0, echo=False,
+                                  temperature=None):
+        # If there's no reply by the time hedge_percentile of recent requests
+        # had theirs, send the same request again and take whichever answer
+        # comes first. The duplicate goes through the rate limiter like any
+        # other request.
+        delay = self.hedge_delay(num_tokens)
+        if delay is None:
+            return await self.send_completions(prompts, num_tokens, timeout, priority, logprobs, echo, temperature)
+
+        tasks = [asyncio.create_task(self.send_completions(prompts, num_tokens, timeout, priority, logprobs, echo, temperature))]
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if not done:
+                self.hedges_sent += 1
+                tasks.append(asyncio.create_task(self.send_completions(prompts, num_tokens, timeout, priority, logprobs, echo, temperature)))
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is not tasks[0]:
+                            self.hedges_won += 1
+                        return task.result()
+            # Both failed; report the original's error.
+            return tasks[0].result()
+        finally:
+            # The loser's HTTP call can't be interrupted, but it gives back
+            # its slot (or its place in the queue) and its answer is dropped.
+            for task in tasks:
+                task.cancel()
+
+    def timed(self, complete, num_tokens):
+        # Run `complete` on the thread pool and record how long it took. This
+        # happens even if nobody waits for the answer any more (because the
+        # hedge won), or the histogram would only ever see the fast requests.
+        loop = asyncio.get_running_loop()
+        start = time.monotonic()
+        def done(future):
+            if not future.cancelled() and future.exception() is None:
+                try:
+                    loop.call_soon_threadsafe(self.latency[num_tokens].observe, time.monotonic() - start)
+                except RuntimeError:
+                    # The engine was closed while this request was out.
+                    pass
+        future = self.executor.submit(complete)
+        future.add_done_callback(done)
+        return future
+
+    async def send_completions(self, prompts, num_tokens, timeout=None, priority=NO_CLOCK, logprobs=0, echo=False,
+                               temperature=None):
+        # `timeout` also goes to the HTTP request itself, so a request we
+        # have given up on doesn't keep a worker thread busy for long. With
+        # `logprobs`, each completion comes back as (text, logprobs); with
+        # `echo`, nothing is generated and we get the prompts' own logprobs.
+        # `temperature` overrides the configured one for plain completions.
+        loop = asyncio.get_running_loop()
+        if echo:
+            complete = functools.partial(self.backend.score, prompts, timeout)
+        elif logprobs:
+            complete = functools.partial(self.backend.complete_logprobs, prompts, num_tokens, logprobs, timeout)
+        else:
+            complete = functools.partial(self.backend.complete, prompts, num_tokens, timeout, temperature, priority)
+        for attempt in range(RATE_LIMIT_RETRIES):
+            # Wait for the rate limit before taking a slot, so that requests
+            # queued behind it don't hold slots others could use.
+            start = time.monotonic()
+            await self.wait_for_rate_limit(prompts, num_tokens, priority)
+            async with self.scheduler.slot(priority):
+                metrics.add_time("queue", time.monotonic() - start)
+                try:
+                    with metrics.span("network"):
+                        out, usage = await asyncio.wrap_future(self.timed(complete, num_tokens), loop=loop)
+                except RateLimited as e:
+                    if self.limiter is None or attempt == RATE_LIMIT_RETRIES-1:
+                        raise
+                    self.limiter.backoff(e.retry_after)
+                    continue
+            if usage is not None:
+                metrics.count("prompt_tokens", usage.get('prompt_tokens', 0))
+                metrics.count("completion_tokens", usage.get('completion_tokens', 0))
+            return out
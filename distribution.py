@@ -0,0 +1,77 @@
+## Copyright (C) 2023, Nicholas Carlini <nicholas@carlini.com>.
+##
+## This program is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import collections
+import math
+
+UNDECIDED = object()
+
+def resolve(text, sans):
+    """
+    Which legal move a completion starting with `text` is playing: its SAN,
+    None if it can't be any legal move, or UNDECIDED if that depends on
+    what comes next. `sans` maps each legal move's SAN without any check
+    mark to its full SAN.
+    """
+    text = text.lstrip()
+    if not text:
+        return UNDECIDED
+    word = text.split()[0]
+    finished = len(text) > len(word)
+    word = word.rstrip("+#")
+    if finished:
+        return sans.get(word)
+    matches = [san for san in sans if san.startswith(word)]
+    if len(matches) == 1:
+        # Whatever else the model might write, this is the only legal move it can be heading for.
+        return sans[matches[0]]
+    return UNDECIDED if matches else None
+
+def move_distribution(board, logprobs):
+    """
+    The model's probability for each legal move in `board`, from a single
+    completion and its `logprobs` (tokens, token_logprobs and top_logprobs,
+    as the OpenAI API returns them). Returns [(san, probability)], most
+    likely first.
+
+    Following the completion token by token, every alternative token that
+    commits to a legal move gets the probability of the prefix so far times
+    its own; the completion's own move gets the rest. Alternatives that
+    don't settle on a single move within that one token can't be followed
+    further, so their probability is left out and the total may be under 1.
+    """
+    sans = {}
+    for move in board.legal_moves:
+        san = board.san(move)
+        sans[san.rstrip("+#")] = san
+
+    probabilities = collections.Counter()
+    prefix = ""
+    logprob = 0.0
+    for token, token_logprob, top in zip(logprobs['tokens'], logprobs['token_logprobs'], logprobs['top_logprobs']):
+        for alternative, alternative_logprob in (top or {}).items():
+            if alternative == token:
+                continue
+            san = resolve(prefix + alternative, sans)
+            if san is not None and san is not UNDECIDED:
+                probabilities[san] += math.exp(logprob + alternative_logprob)
+        prefix += token
+        logprob += token_logprob
+        san = resolve(prefix, sans)
+        if san is not UNDECIDED:
+            if san is not None:
+                probabilities[san] += math.exp(logprob)
+            break
+    return probabilities.most_common()
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+## Copyright (C) 2023, Nicholas Carlini <nicholas@carlini.com>.
+##
+## This program is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Writes the positions in the move cache out as a polyglot opening book,
+# so that lichess-bot can play them from its book without calling ChessLLM.
+#
+# Each position gets the model's move, weighted by how often the position
+# was stored or played from the cache. With --incremental, only positions
+# that changed since the last export are read from the cache and merged into
+# the existing book; the time of the last export is kept next to the book.
+
+import argparse
+import json
+import os
+import struct
+import time
+import chess
+import chess.polyglot
+from movecache import MoveCache
+
+ENTRY = struct.Struct(">QHHI")  # key, move, weight, learn
+
+# Writers may commit a little after the time they stamped their rows with,
+# so every export looks back this many seconds before the last one.
+OVERLAP = 60
+
+def encode_move(board, move):
+    to_square = move.to_square
+    if board.is_castling(move):
+        # Polyglot writes castling as the king taking its own rook.
+        to_square = chess.square(7 if board.is_kingside_castling(move) else 0, chess.square_rank(move.from_square))
+    promotion = move.promotion - 1 if move.promotion else 0
+    return to_square | move.from_square << 6 | promotion << 12
+
+def read_book(path):
+    # key -> (move, weight). Our books have one move per position.
+    with open(path, "rb") as f:
+        return {key: (move, weight) for key, move, weight, _ in ENTRY.iter_unpack(f.read())}
+
+def write_book(path, entries, min_weight):
+    # Polyglot readers binary-search the file, so it must be sorted by key.
+    # Replace the book in one go so a bot reading it never sees half of it.
+    tmp = path + ".tmp"
+    written = 0
+    with open(tmp, "wb") as f:
+        for key in sorted(entries):
+            move, weight = entries[key]
+            if weight >= min_weight:
+                f.write(ENTRY.pack(key, move, weight, 0))
+                written += 1
+    os.replace(tmp, path)
+    return written
+
+def export(cache, path, incremental=False, min_weight=1):
+    stamp_path = path + ".updated"
+    entries, since = {}, -1
+    if incremental and os.path.exists(path) and os.path.exists(stamp_path):
+        entries = read_book(path)
+        since = json.load(open(stamp_path)) - OVERLAP
+    started = time.time()
+    rows = cache.changed_since(since)
+    for epd, san, hits, _ in rows:
+        board, _ = chess.Board.from_epd(epd)
+        try:
+            move = board.parse_san(san)
+        except ValueError:
+            continue
+        entries[chess.polyglot.zobrist_hash(board)] = (encode_move(board, move), min(hits, 0xffff))
+    written = write_book(path, entries, min_weight)
+    with open(stamp_path, "w") as f:
+        json.dump(started, f)
+    return len(rows), written
+
+def main():
+    parser = argparse.ArgumentParser(description="Export the move cache as a polyglot opening book.")
+    parser.add_argument("book", help="Path of the .bin book to write.")
+    parser.add_argument("--cache", default=None, help="Cache file (default: cache_path from config.json).")
+    parser.add_argument("--incremental", action="store_true", help="Only merge in what changed since the last export.")
+    parser.add_argument("--min-weight", type=int, default=1, help="Leave out positions seen fewer times than this.")
+    args = parser.parse_args()
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    config = json.loads(open(os.path.join(here, "config.json")).read())
+    cache = MoveCache(args.cache or os.path.join(here, config.get('cache_path', "cache.db")))
+    read, written = export(cache, args.book, args.incremental, args.min_weight)
+    print("Read", read, "positions from the cache; the book has", written, "entries")
+
+if __name__ == "__main__":
+    main()
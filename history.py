@@ -0,0 +1,54 @@
+## Copyright (C) 2023, Nicholas Carlini <nicholas@carlini.com>.
+##
+## This program is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import hashlib
+
+def history_key(root_fen, moves):
+    # Same as history_keys(root_fen, moves)[-1], without the intermediate keys.
+    text = root_fen + "".join(" " + move.uci() for move in moves)
+    return hashlib.sha256(text.encode()).digest()[:16]
+
+def history_digest(root_fen):
+    # The running hash behind the keys: add moves with push_digest, and
+    # digest()[:16] is the key of the game so far.
+    return hashlib.sha256(root_fen.encode())
+
+def push_digest(digest, move):
+    digest.update(b" " + move.uci().encode())
+
+def extended_key(digest, moves):
+    # The key of the game `digest` stands for, followed by `moves`.
+    digest = digest.copy()
+    for move in moves:
+        push_digest(digest, move)
+    return digest.digest()[:16]
+
+def history_keys(root_fen, moves):
+    """
+    The cache key of every position along `moves` from `root_fen`: the
+    i-th key stands for the game after the first i moves. Two positions get
+    the same key only if they were reached by the same moves, i.e. if the
+    model was shown the same prompt.
+    """
+    digest = history_digest(root_fen)
+    keys = [digest.digest()[:16]]
+    for move in moves:
+        push_digest(digest, move)
+        keys.append(digest.copy().digest()[:16])
+    return keys
+
+def table_key(key):
+    # A history key cut down to the 64 bits a MoveTable holds.
+    return int.from_bytes(key[:8], "big")
@@ -5,11 +5,15 @@ With these classes, bot makers will not have to implement the UCI or XBoard inte
 """
 
 from __future__ import annotations
+import asyncio
+import math
+import time
 import chess
+import chess.polyglot
 from chess.engine import PlayResult
 import random
 from engine_wrapper import MinimalEngine
-from typing import Any, Union
+from typing import Any, Optional, Union
 import logging
 MOVE = Union[chess.engine.PlayResult, list[chess.Move]]
 
@@ -107,16 +111,337 @@ class LLM(ExampleEngine):
         config = json.loads(open("../config.json").read())
         self.my_engine = ChessLLM(api_key, config)
 
-    def search(self, board: chess.Board, *args: Any) -> PlayResult:
+    def time_budget(self, board: chess.Board, time_limit: chess.engine.Limit) -> float:
+        """
+        Decide how long we can wait for the model before falling back to a local move.
+
+        :param board: The current position.
+        :param time_limit: Conditions for how long the engine can search.
+        :return: The time budget for this move, in seconds.
+        """
+        if time_limit.time is not None:
+            return time_limit.time
+        if board.turn == chess.WHITE:
+            my_time = time_limit.white_clock or 0
+            my_inc = time_limit.white_inc or 0
+        else:
+            my_time = time_limit.black_clock or 0
+            my_inc = time_limit.black_inc or 0
+        return min(my_time / 30 + my_inc, my_time / 2)
+
+    def clock(self, board: chess.Board, time_limit: chess.engine.Limit, conversation: Any) -> Optional[float]:
+        """
+        Get the time left on our clock, which decides whose requests go first when games compete for the API.
+
+        :param board: The current position.
+        :param time_limit: Conditions for how long the engine can search.
+        :param conversation: The game's conversation, which knows the game's full clock.
+        :return: The time left in seconds, or None if the game has no clock.
+        """
+        if conversation is not None:
+            # The Limit for correspondence and first moves only has the search time.
+            return float(conversation.game.my_remaining_time().total_seconds())
+        my_clock = time_limit.white_clock if board.turn == chess.WHITE else time_limit.black_clock
+        return my_clock if my_clock is not None else time_limit.time
+
+    def get_stats(self, for_chat: bool = False) -> list[str]:
+        """
+        Get where the time and tokens went over this game's moves, for the logs and the `!eval` command.
+
+        :param for_chat: Whether the stats will be sent to the game chat, which has a 140 character limit.
+        """
+        summary = self.my_engine.metrics_summary()
+        if not summary["moves"]:
+            return []
+        stats = [f"Moves: {summary['moves']}",
+                 f"Cached: {summary['cache_hit_rate']:.0%}",
+                 f"Illegal: {summary['illegal_rate']:.0%}",
+                 f"Tokens/move: {summary['tokens_per_move']:.0f}",
+                 f"Time/move: {summary['total_p50']:.2f}s (p90 {summary['total_p90']:.2f}s)"]
+        if not for_chat:
+            stats += [f"{name[:-4].replace('_', ' ').title()}: {summary[name]:.3f}s (p90 {summary[name[:-4] + '_p90']:.3f}s)"
+                      for name in summary if name.endswith("_p50") and name != "total_p50"]
+        return stats
+
+    def quit(self) -> None:
+        """Close the engine, and with it the model's event loop, thread pool and connections."""
+        super().quit()
+        self.my_engine.close()
+
+    def search(self, board: chess.Board, time_limit: chess.engine.Limit, ponder: bool, *args: Any) -> PlayResult:
         conversation = args[-1]
 
         new_board = board.copy()
-        move = self.my_engine.get_best_move(board, conversation=conversation)
+        move = self.my_engine.get_best_move(board, conversation=conversation,
+                                            time_budget=self.time_budget(board, time_limit),
+                                            clock=self.clock(board, time_limit, conversation))
         new_board.push_san(move)
 
+        if ponder:
+            # Ask about the opponent's likely replies while their clock runs.
+            self.my_engine.ponder(new_board)
+
         move = new_board.peek()
         
         return PlayResult(move, None)
 
-        
 
+class TreeNode:
+    """A position in LLMTreeSearch's tree, shared by every line that reaches it."""
+
+    def __init__(self) -> None:
+        """Start with no visits and no children."""
+        self.visits = 0
+        # The sum of the results of the visits, from the point of view of the side to move here.
+        self.value = 0.0
+        # The model's probability for each move, once the node is expanded.
+        self.priors: Optional[dict[chess.Move, float]] = None
+
+
+class LLMTreeSearch(LLM):
+    """
+    Monte Carlo tree search guided by the model.
+
+    Each new position is expanded with one `get_move_distribution` request, whose probabilities are the priors of its
+    moves. The same request's greedy reply lands in the move cache, so the rollout from it (following the model's
+    cached moves, then counting material) costs no further requests. Several leaves are expanded at once, with a
+    virtual loss on the lines being expanded so that they are spread over the tree. Nodes are kept by Zobrist hash, so
+    transpositions share them and the tree carries over from move to move. The tree is this engine's own: its priors
+    and visits aren't stored in the move cache, and other games don't see them.
+    """
+
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        """Set up the model and an empty tree."""
+        super().__init__(*args, **kwargs)  # type: ignore[no-untyped-call]
+        import localsearch  # type: ignore[import]
+        self.localsearch = localsearch
+        config = self.my_engine.config
+        self.batch_size = config.get('tree_search_batch', 8)
+        self.c_puct = config.get('tree_search_c_puct', 1.5)
+        self.rollout_plies = config.get('tree_search_rollout_plies', 8)
+        self.max_nodes = config.get('tree_search_max_nodes', 100000)
+        self.nodes: dict[int, TreeNode] = {}
+
+    def node(self, board: chess.Board) -> TreeNode:
+        """
+        Get the tree's node for a position, adding it if it is new.
+
+        :param board: The position.
+        :return: Its node.
+        """
+        key = chess.polyglot.zobrist_hash(board)
+        node = self.nodes.get(key)
+        if node is None:
+            node = self.nodes[key] = TreeNode()
+        return node
+
+    def select(self, board: chess.Board) -> tuple[list[TreeNode], chess.Board]:
+        """
+        Walk down the tree by PUCT to a position that hasn't been expanded, adding a virtual loss on the way.
+
+        :param board: The root position.
+        :return: The nodes along the way (root first) and the position reached.
+        """
+        board = board.copy()
+        node = self.node(board)
+        path = [node]
+        while node.priors and board.outcome() is None and not board.is_repetition(2):
+            sqrt_visits = math.sqrt(node.visits + 1)
+
+            def puct(move: chess.Move) -> float:
+                board.push(move)
+                child = self.node(board)
+                board.pop()
+                q = -child.value / child.visits if child.visits else 0.0
+                return float(q + self.c_puct * node.priors[move] * sqrt_visits / (1 + child.visits))  # type: ignore[index]
+
+            board.push(max(node.priors, key=puct))
+            node = self.node(board)
+            path.append(node)
+        # Count the visit now, as a loss for whoever moved into each node, until the real result comes back.
+        for node in path:
+            node.visits += 1
+            node.value += 1
+        return path, board
+
+    def rollout(self, board: chess.Board) -> float:
+        """
+        Play on with the moves the model predicted (from the cache only), then score the material.
+
+        :param board: The position to evaluate.
+        :return: The result, between -1 and 1, from the point of view of the side to move in `board`.
+        """
+        start = board.turn
+        board = board.copy()
+        for _ in range(self.rollout_plies):
+            if board.outcome() is not None:
+                break
+            move = self.my_engine.cached_move(board)
+            if move is None:
+                break
+            board.push_san(move)
+        outcome = board.outcome()
+        if outcome is not None:
+            return 0.0 if outcome.winner is None else (1.0 if outcome.winner == start else -1.0)
+        score = self.localsearch.evaluate(board)
+        return math.tanh((score if board.turn == start else -score) / 400)
+
+    async def expand(self, board: chess.Board, clock: Optional[float]) -> float:
+        """
+        Ask the model for the move probabilities in a position, then evaluate it.
+
+        :param board: A position that hasn't been expanded yet.
+        :param clock: The time left on our clock, if there is one.
+        :return: Its value, from the point of view of the side to move.
+        """
+        if board.is_repetition(2):
+            # Going round in circles; call it a draw.
+            return 0.0
+        node = self.node(board)
+        if node.priors is None and board.outcome() is None:
+            distribution = await self.my_engine.find_move_distribution(board, clock=clock)
+            priors = {board.parse_san(san): probability for san, probability in distribution}
+            if not priors:
+                # Nothing usable came back; let the search try every move.
+                priors = {move: 1.0 for move in board.legal_moves}
+            total = sum(priors.values())
+            node.priors = {move: probability / total for move, probability in priors.items()}
+        return self.rollout(board)
+
+    def backup(self, path: list[TreeNode], value: float) -> None:
+        """
+        Replace the virtual loss along a path with the real result.
+
+        :param path: The nodes from the root to the leaf.
+        :param value: The result from the point of view of the side to move at the leaf.
+        """
+        for node in reversed(path):
+            node.value += value - 1
+            value = -value
+
+    def undo(self, path: list[TreeNode]) -> None:
+        """
+        Take back the virtual loss of a line whose expansion didn't finish.
+
+        :param path: The nodes from the root to the leaf.
+        """
+        for node in path:
+            node.visits -= 1
+            node.value -= 1
+
+    def principal_variation(self, board: chess.Board) -> list[chess.Move]:
+        """
+        Follow the most visited moves from a position.
+
+        :param board: The root position.
+        :return: The moves.
+        """
+        board = board.copy()
+        pv: list[chess.Move] = []
+        while not board.is_repetition(2):
+            priors = self.node(board).priors
+            if not priors or board.outcome() is not None:
+                return pv
+
+            def visits(move: chess.Move) -> int:
+                board.push(move)
+                count = self.node(board).visits
+                board.pop()
+                return count
+
+            move = max(priors, key=visits)
+            if visits(move) == 0:
+                return pv
+            pv.append(move)
+            board.push(move)
+        return pv
+
+    async def tree_search(self, board: chess.Board, time_budget: float, max_nodes: Optional[int],
+                          clock: Optional[float]) -> tuple[list[chess.Move], int]:
+        """
+        Search until the time budget or the node limit runs out.
+
+        :param board: The root position.
+        :param time_budget: How long to search, in seconds.
+        :param max_nodes: How many positions to expand at most, if limited.
+        :param clock: The time left on our clock, if there is one.
+        :return: The principal variation and the number of positions expanded.
+        """
+        deadline = time.monotonic() + time_budget
+        expanded = 0
+        while max_nodes is None or expanded < max_nodes:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            leaves: dict[int, tuple[chess.Board, list[list[TreeNode]]]] = {}
+            for _ in range(self.batch_size if max_nodes is None else min(self.batch_size, max_nodes - expanded)):
+                path, leaf = self.select(board)
+                # Two lines ending in the same position share its request.
+                leaves.setdefault(chess.polyglot.zobrist_hash(leaf), (leaf, []))[1].append(path)
+            try:
+                values = await asyncio.wait_for(asyncio.gather(*[self.expand(leaf, clock) for leaf, _ in leaves.values()]),
+                                                remaining)
+            except Exception as e:
+                # Out of time, or the model couldn't be reached: keep what we have.
+                logger.info(f"Tree search stopped after {expanded} positions: {e!r}")
+                for _, paths in leaves.values():
+                    for path in paths:
+                        self.undo(path)
+                break
+            for (_, paths), value in zip(leaves.values(), values):
+                for path in paths:
+                    self.backup(path, value)
+            expanded += len(leaves)
+        return self.principal_variation(board), expanded
+
+    def search(self, board: chess.Board, time_limit: chess.engine.Limit, ponder: bool, *args: Any) -> PlayResult:
+        """
+        Choose the most visited move after a tree search.
+
+        :param board: The current position.
+        :param time_limit: Conditions for how long the engine can search.
+        :param ponder: Whether the engine can ponder after playing a move.
+        :return: The move to play, with the nodes searched, the speed and the principal variation in its info.
+        """
+        conversation = args[-1]
+        if len(self.nodes) > self.max_nodes:
+            self.nodes.clear()
+        start = time.monotonic()
+        # Leave time for the fallback move in case nothing comes back.
+        budget = self.time_budget(board, time_limit) - self.my_engine.config.get('fallback_time', 0.05) - 0.05
+        clock = self.clock(board, time_limit, conversation)
+        pv, nodes = self.my_engine.run(self.tree_search(board, budget, time_limit.nodes, clock))
+        elapsed = time.monotonic() - start
+
+        if pv:
+            move = pv[0]
+        else:
+            move = board.parse_san(self.my_engine.fallback_move(board))
+        info: chess.engine.InfoDict = {"nodes": nodes, "nps": int(nodes / elapsed) if elapsed > 0 else 0,
+                                       "time": elapsed, "depth": len(pv)}
+        if pv:
+            info["pv"] = pv
+            root = self.node(board)
+            after = board.copy()
+            after.push(move)
+            child = self.node(after)
+            if child.visits:
+                # The root move's average result, as centipawns.
+                q = max(-0.999, min(0.999, -child.value / child.visits))
+                info["score"] = chess.engine.PovScore(chess.engine.Cp(round(400 * math.atanh(q))), board.turn)
+            logger.info(f"Tree search: {nodes} positions in {elapsed:.2f}s, {root.visits} visits at the root")
+
+        if ponder:
+            new_board = board.copy()
+            new_board.push(move)
+            self.my_engine.ponder(new_board)
+        return PlayResult(move, pv[1] if len(pv) > 1 else None, info)
+
+    def get_stats(self, for_chat: bool = False) -> list[str]:
+        """
+        Get the search's stats for the last move, plus the model's timings and token counts outside of the chat.
+
+        :param for_chat: Whether the stats will be sent to the game chat, which has a 140 character limit.
+        """
+        stats = ExampleEngine.get_stats(self, for_chat)
+        return stats if for_chat else stats + super().get_stats(for_chat)
@@ -0,0 +1,166 @@
+## Copyright (C) 2023, Nicholas Carlini <nicholas@carlini.com>.
+##
+## This program is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# A tiny pure-python alpha-beta search on material, for when there's no time
+# left to ask the model. It plays terribly but it plays instantly.
+
+import time
+import chess
+
+PIECE_VALUES = {chess.PAWN: 100, chess.KNIGHT: 320, chess.BISHOP: 330,
+                chess.ROOK: 500, chess.QUEEN: 900, chess.KING: 0}
+MATE = 100000
+
+class OutOfTime(Exception):
+    pass
+
+def evaluate(board):
+    """Material balance in centipawns, from the side to move's point of view."""
+    score = 0
+    for piece_type, value in PIECE_VALUES.items():
+        score += value * (chess.popcount(board.pieces_mask(piece_type, chess.WHITE))
+                          - chess.popcount(board.pieces_mask(piece_type, chess.BLACK)))
+    return score if board.turn == chess.WHITE else -score
+
+def ordered_moves(board):
+    # Captures first, most valuable victim first, then everything else.
+    def key(move):
+        if board.is_en_passant(move):
+            return -PIECE_VALUES[chess.PAWN]
+        victim = board.piece_type_at(move.to_square)
+        return -PIECE_VALUES[victim] if victim else 0
+    return sorted(board.legal_moves, key=key)
+
+def quiesce(board, alpha, beta, deadline):
+    # Only captures and promotions, so a search never stops halfway
+    # through an exchange. Standing pat stands in for the quiet moves.
+    if time.monotonic() > deadline:
+        raise OutOfTime()
+    score = evaluate(board)
+    if score >= beta:
+        return score
+    alpha = max(alpha, score)
+    for move in ordered_moves(board):
+        if not board.is_capture(move) and not move.promotion:
+            continue
+        board.push(move)
+        score = -quiesce(board, -beta, -alpha, deadline)
+        board.pop()
+        if score >= beta:
+            return score
+        alpha = max(alpha, score)
+    return alpha
+
+def negamax(board, depth, alpha, beta, deadline):
+    if time.monotonic() > deadline:
+        raise OutOfTime()
+    if board.is_checkmate():
+        return -MATE - depth
+    if board.is_stalemate() or board.is_insufficient_material():
+        return 0
+    if depth == 0:
+        return quiesce(board, alpha, beta, deadline)
+
+    for move in ordered_moves(board):
+        board.push(move)
+        score = -negamax(board, depth-1, -beta, -alpha, deadline)
+        board.pop()
+        if score >= beta:
+            return score
+        alpha = max(alpha, score)
+    return alpha
+
+def best_move(board, time_limit=0.05, max_depth=4):
+    """
+    Iterative deepening up to `max_depth` plies. Returns the best move of the
+    deepest search that finished within `time_limit` seconds, or None if the
+    game is over.
+    """
+    deadline = time.monotonic() + time_limit
+    moves = ordered_moves(board)
+    if not moves:
+        return None
+    board = board.copy(stack=False)
+
+    best = moves[0]
+    for depth in range(1, max_depth+1):
+        try:
+            alpha = -MATE * 2
+            depth_best = None
+            for move in moves:
+                board.push(move)
+                score = -negamax(board, depth-1, -MATE * 2, -alpha, deadline)
+                board.pop()
+                if depth_best is None or score > alpha:
+                    alpha = score
+                    depth_best = move
+        except OutOfTime:
+            break
+        best = depth_best
+        # Search the previous best move first next time round.
+        moves.remove(best)
+        moves.insert(0, best)
+    return best
+
+def ranked_moves(board, time_limit=0.02, depth=2):
+    """
+    All legal moves, best first by a `depth`-ply search. If that doesn't
+    finish in `time_limit` seconds, the plain capture-first order.
+    """
+    deadline = time.monotonic() + time_limit
+    moves = ordered_moves(board)
+    board = board.copy(stack=False)
+    scores = {}
+    try:
+        for move in moves:
+            board.push(move)
+            scores[move] = -negamax(board, depth-1, -MATE * 2, MATE * 2, deadline)
+            board.pop()
+    except OutOfTime:
+        return moves
+    return sorted(moves, key=lambda move: -scores[move])
+
+def refute(board, move, margin, time_limit=0.05, max_depth=2):
+    """
+    Check `move` for a blunder: iterative deepening up to `max_depth` plies
+    (plus captures) looks for a move that scores more than `margin`
+    centipawns better. Returns (better move, centipawns lost) from the
+    deepest search that finished within `time_limit` seconds, or None if
+    no move is that much better or not even a 1-ply search finished.
+    """
+    deadline = time.monotonic() + time_limit
+    board = board.copy(stack=False)
+    found = None
+    for depth in range(1, max_depth+1):
+        try:
+            board.push(move)
+            score = -negamax(board, depth-1, -MATE * 2, MATE * 2, deadline)
+            board.pop()
+            # Only moves beating the bar need an exact score.
+            alpha = score + margin
+            depth_found = None
+            for other in ordered_moves(board):
+                if other == move:
+                    continue
+                board.push(other)
+                other_score = -negamax(board, depth-1, -MATE * 2, -alpha, deadline)
+                board.pop()
+                if other_score > alpha:
+                    alpha = other_score
+                    depth_found = (other, other_score - score)
+        except OutOfTime:
+            break
+        found = depth_found
+    return found
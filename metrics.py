@@ -0,0 +1,160 @@
+## Copyright (C) 2023, Nicholas Carlini <nicholas@carlini.com>.
+##
+## This program is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import bisect
+import collections
+import contextlib
+import contextvars
+import json
+import threading
+import time
+
+class Histogram:
+    """
+    Latencies (or any positive values) in logarithmic buckets, from
+    `smallest` up, each `growth` times wider than the last.
+
+    To follow changes over time, all counts are halved whenever more than
+    `window` values have been added since the last halving, so old values
+    fade out and percentiles describe roughly the last `window` values.
+    """
+    def __init__(self, smallest=1e-5, growth=1.25, buckets=80, window=1000):
+        self.bounds = [smallest * growth ** i for i in range(buckets)]
+        self.counts = [0.0] * (buckets + 1)
+        self.window = window
+        self.total = 0.0
+        self.since_decay = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.total += 1
+        self.since_decay += 1
+        if self.since_decay > self.window:
+            self.counts = [count / 2 for count in self.counts]
+            self.total /= 2
+            self.since_decay = 0
+
+    def percentile(self, q):
+        # The upper bound of the bucket holding the q-th quantile (0 < q <= 1).
+        if self.total == 0:
+            return None
+        seen = 0.0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= q * self.total:
+                return self.bounds[i] if i < len(self.bounds) else float('inf')
+        return float('inf')
+
+# The MoveTrace of the get_best_move call we are in, if any. asyncio tasks
+# inherit it, so spans recorded deep inside a request end up on the move
+# that caused it.
+current_trace = contextvars.ContextVar('current_trace', default=None)
+
+class MoveTrace:
+    """Where the time went on one move: named spans in seconds, and counters."""
+    def __init__(self):
+        self.start = time.monotonic()
+        self.spans = collections.Counter()
+        self.counts = collections.Counter()
+        self.outcome = None
+
+    @contextlib.contextmanager
+    def span(self, name):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.spans[name] += time.monotonic() - start
+
+    def add_time(self, name, seconds):
+        self.spans[name] += seconds
+
+    def total(self):
+        return time.monotonic() - self.start
+
+def span(name, trace=None):
+    # Time a span on `trace`, or on the current move's trace if there is one.
+    trace = trace or current_trace.get()
+    return trace.span(name) if trace is not None else contextlib.nullcontext()
+
+def add_time(name, seconds, trace=None):
+    trace = trace or current_trace.get()
+    if trace is not None:
+        trace.add_time(name, seconds)
+
+def count(name, n=1, trace=None):
+    trace = trace or current_trace.get()
+    if trace is not None:
+        trace.counts[name] += n
+
+class MoveMetrics:
+    """
+    Aggregates the MoveTrace of every move: a Histogram per span (plus
+    "total", and "model_total" for the moves the model answered), summed
+    counters, and how many moves ended each way ("cache", "model", "scored"
+    when the legal moves were ranked after an illegal reply, "fallback", or
+    "none" when there was no move to return). With a `path`,
+    every move is also appended to that file as a line of JSON.
+    """
+    def __init__(self, path=None):
+        self.path = path
+        self.histograms = collections.defaultdict(Histogram)
+        self.counts = collections.Counter()
+        self.outcomes = collections.Counter()
+        self.lock = threading.Lock()
+
+    def record(self, trace, fen):
+        total = trace.total()
+        with self.lock:
+            self.histograms["total"].observe(total)
+            if trace.outcome == "model":
+                self.histograms["model_total"].observe(total)
+            for name, seconds in trace.spans.items():
+                self.histograms[name].observe(seconds)
+            self.counts.update(trace.counts)
+            self.outcomes[trace.outcome] += 1
+        if self.path is not None:
+            line = json.dumps({"time": time.time(), "fen": fen, "outcome": trace.outcome, "total": total,
+                               "spans": trace.spans, "counts": trace.counts})
+            # One write per line, in append mode, so that lines from several
+            # processes sharing the file don't get mixed up.
+            with open(self.path, "a") as f:
+                f.write(line + "\n")
+
+    def summary(self):
+        with self.lock:
+            moves = sum(self.outcomes.values())
+            queried = moves - self.outcomes["cache"]
+            out = {"moves": moves,
+                   "cache_hit_rate": self.outcomes["cache"] / moves if moves else 0.0,
+                   "illegal_rate": self.counts["illegal_replies"] / queried if queried else 0.0,
+                   "fallback_rate": self.outcomes["fallback"] / queried if queried else 0.0,
+                   "scored_rate": self.outcomes["scored"] / queried if queried else 0.0,
+                   "blunder_rate": (self.counts["blunders_replaced"] / self.counts["verified_moves"]
+                                    if self.counts["verified_moves"] else 0.0),
+                   "tokens_per_move": ((self.counts["prompt_tokens"] + self.counts["completion_tokens"]) / queried
+                                       if queried else 0.0)}
+            for tier in ("history", "position"):
+                out[f"{tier}_hits"] = self.counts[f"{tier}_hits"]
+                out[f"{tier}_misses"] = self.counts[f"{tier}_misses"]
+            for name, histogram in self.histograms.items():
+                out[f"{name}_p50"] = histogram.percentile(0.5)
+                out[f"{name}_p90"] = histogram.percentile(0.9)
+            # Roughly what the cache saved: each hit would otherwise have
+            # taken as long as a typical move answered by the model.
+            model, lookup = out.get("model_total_p50"), out.get("cache_lookup_p50")
+            out["latency_saved"] = (self.outcomes["cache"] * (model - lookup)
+                                    if model is not None and lookup is not None else 0.0)
+            return out
@@ -0,0 +1,192 @@
+## Copyright (C) 2023, Nicholas Carlini <nicholas@carlini.com>.
+##
+## This program is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import pickle
+import sqlite3
+import sys
+import threading
+import time
+
+class MoveCache:
+    """
+    Persistent cache of the model's moves (in SAN) backed by sqlite in WAL
+    mode, in two tables: `replies`, keyed by the game's exact move history
+    (see history.history_key), and `moves`, keyed by position (EPD, i.e. a
+    FEN without the move counters). `moves` also counts how often each
+    position was stored or played from the cache, and when it last was.
+
+    Lookups go straight to disk, so nothing is loaded up front, and each
+    update only writes the new entries instead of rewriting the whole file.
+
+    Several processes (e.g. the lichess-bot game workers) can open the same
+    file at once: sqlite serializes the writers, WAL lets readers carry on
+    while someone writes, and since nothing is held in memory an entry
+    committed by one process is seen by the next lookup in any other.
+
+    The same file also holds short-lived claims on positions that some
+    process is currently asking the model about; see SingleFlight.
+    """
+    def __init__(self, path="cache.db", legacy_paths=None, timeout=30):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=timeout, isolation_level=None,
+                                    check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS moves (fen TEXT PRIMARY KEY, move TEXT NOT NULL)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS replies (key BLOB PRIMARY KEY, move TEXT NOT NULL) WITHOUT ROWID")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS claims (fen TEXT PRIMARY KEY, expires REAL NOT NULL)")
+
+        if legacy_paths is None:
+            legacy_paths = [os.path.join(os.path.dirname(path), "cache.p")]
+        for legacy_path in legacy_paths:
+            if os.path.exists(legacy_path):
+                self.migrate(legacy_path)
+        self.upgrade()
+
+    def write(self, sql, rows):
+        # BEGIN IMMEDIATE takes the write lock up front, so two processes
+        # can't both start a transaction and then deadlock upgrading it.
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                self.conn.executemany(sql, rows)
+                self.conn.execute("COMMIT")
+            except:
+                self.conn.execute("ROLLBACK")
+                raise
+
+    def migrate(self, legacy_path):
+        # One-shot import of the old pickled dict. The pickle is renamed
+        # afterwards so we never import it twice. Hold the write lock while
+        # doing it so only one of several starting processes does the work.
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                if not os.path.exists(legacy_path):
+                    self.conn.execute("COMMIT")
+                    return
+                with open(legacy_path, "rb") as f:
+                    old = pickle.load(f)
+                self.conn.executemany("INSERT OR IGNORE INTO moves (fen, move) VALUES (?, ?)",
+                                      [(" ".join(fen.split()[:4]), move) for fen, move in old.items()])
+                os.replace(legacy_path, legacy_path + ".migrated")
+                self.conn.execute("COMMIT")
+            except:
+                self.conn.execute("ROLLBACK")
+                raise
+        print("Migrated", len(old), "entries from", legacy_path, file=sys.stderr)
+
+    def upgrade(self):
+        # Version 1 keys `moves` by EPD instead of the full FEN, so that the
+        # move counters don't get in the way of a hit. Version 2 adds the
+        # hit counts and update times, for export_book.py.
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                version = self.conn.execute("PRAGMA user_version").fetchone()[0]
+                if version < 1:
+                    rows = self.conn.execute("SELECT fen, move FROM moves").fetchall()
+                    self.conn.execute("DELETE FROM moves")
+                    self.conn.executemany("INSERT OR IGNORE INTO moves (fen, move) VALUES (?, ?)",
+                                          [(" ".join(fen.split()[:4]), move) for fen, move in rows])
+                if version < 2:
+                    self.conn.execute("ALTER TABLE moves ADD COLUMN hits INTEGER NOT NULL DEFAULT 1")
+                    self.conn.execute("ALTER TABLE moves ADD COLUMN updated REAL NOT NULL DEFAULT 0")
+                    self.conn.execute("PRAGMA user_version = 2")
+                self.conn.execute("COMMIT")
+            except:
+                self.conn.execute("ROLLBACK")
+                raise
+
+    def get_reply(self, key):
+        with self.lock:
+            row = self.conn.execute("SELECT move FROM replies WHERE key = ?", (key,)).fetchone()
+        return None if row is None else row[0]
+
+    def update_replies(self, entries):
+        self.write("INSERT OR REPLACE INTO replies VALUES (?, ?)", entries.items())
+
+    def get(self, fen, default=None):
+        with self.lock:
+            row = self.conn.execute("SELECT move FROM moves WHERE fen = ?", (fen,)).fetchone()
+        return default if row is None else row[0]
+
+    def update(self, entries):
+        now = time.time()
+        self.write("INSERT INTO moves (fen, move, updated) VALUES (?, ?, ?) "
+                   "ON CONFLICT (fen) DO UPDATE SET move = excluded.move, hits = hits + 1, updated = excluded.updated",
+                   [(fen, move, now) for fen, move in entries.items()])
+
+    def hit(self, fen):
+        # The move for `fen` was played straight from the cache.
+        self.write("UPDATE moves SET hits = hits + 1, updated = ? WHERE fen = ?", [(time.time(), fen)])
+
+    def changed_since(self, updated):
+        # (fen, move, hits, updated) for every position stored or hit after `updated`.
+        with self.lock:
+            return self.conn.execute("SELECT fen, move, hits, updated FROM moves WHERE updated > ?",
+                                     (updated,)).fetchall()
+
+    def claim(self, fen, ttl):
+        # True if we now own `fen` for the next `ttl` seconds. Claims left
+        # behind by a process that died are taken over once they expire.
+        now = time.time()
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                self.conn.execute("DELETE FROM claims WHERE fen = ? AND expires < ?", (fen, now))
+                cursor = self.conn.execute("INSERT OR IGNORE INTO claims VALUES (?, ?)", (fen, now + ttl))
+                self.conn.execute("COMMIT")
+            except:
+                self.conn.execute("ROLLBACK")
+                raise
+        return cursor.rowcount == 1
+
+    def claimed(self, fen):
+        with self.lock:
+            row = self.conn.execute("SELECT 1 FROM claims WHERE fen = ? AND expires >= ?",
+                                    (fen, time.time())).fetchone()
+        return row is not None
+
+    def release(self, fen):
+        self.write("DELETE FROM claims WHERE fen = ?", [(fen,)])
+
+    def __getitem__(self, fen):
+        out = self.get(fen)
+        if out is None:
+            raise KeyError(fen)
+        return out
+
+    def __setitem__(self, fen, move):
+        self.update({fen: move})
+
+    def __contains__(self, fen):
+        return self.get(fen) is not None
+
+    def __len__(self):
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM moves").fetchone()[0]
+
+    def legacy_count(self):
+        # Positions imported from cache.p that nothing has stored or played
+        # since; they have no update time.
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM moves WHERE updated = 0").fetchone()[0]
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
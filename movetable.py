@@ -0,0 +1,111 @@
+## Copyright (C) 2023, Nicholas Carlini <nicholas@carlini.com>.
+##
+## This program is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+from array import array
+import chess
+
+def encode_move(move):
+    # from (6 bits) | to (6 bits) | promotion piece type (3 bits)
+    return move.from_square | move.to_square << 6 | (move.promotion or 0) << 12
+
+def decode_move(code):
+    return chess.Move(code & 63, code >> 6 & 63, code >> 12 or None)
+
+class MoveTable:
+    """
+    A fixed-size in-memory map from 64-bit keys (Zobrist hashes, or the
+    first 8 bytes of a history.history_key) to moves.
+
+    Keys and moves live in flat arrays (8 + 2 bytes a slot, plus a byte for
+    the clock bit) with linear probing, at most 3/4 full and rounded up to a
+    power of two, so an entry costs 15 to 30 bytes against around 200 for a
+    FEN -> SAN dict. Once it holds `capacity` entries, each new one evicts
+    an entry that hasn't been used since the clock hand last passed it.
+    """
+    def __init__(self, capacity):
+        self.capacity = capacity
+        slots = 16
+        while slots * 3 < capacity * 4:
+            slots *= 2
+        self.mask = slots - 1
+        self.keys = array('Q', bytes(8 * slots))
+        self.moves = array('H', bytes(2 * slots))
+        self.used = bytearray(slots)
+        self.count = 0
+        self.hand = 0
+        self.lock = threading.Lock()
+
+    def find(self, key):
+        # The slot holding `key`, or the empty slot where it would go.
+        i = key & self.mask
+        while self.keys[i] and self.keys[i] != key:
+            i = (i + 1) & self.mask
+        return i
+
+    def get(self, key):
+        key = key or 1  # 0 marks an empty slot
+        with self.lock:
+            i = self.find(key)
+            if not self.keys[i]:
+                return None
+            self.used[i] = 1
+            return self.moves[i]
+
+    def put(self, key, move):
+        key = key or 1
+        with self.lock:
+            i = self.find(key)
+            if not self.keys[i]:
+                if self.count >= self.capacity:
+                    self.evict()
+                    i = self.find(key)
+                self.keys[i] = key
+                self.count += 1
+            self.moves[i] = move
+            self.used[i] = 1
+
+    def evict(self):
+        while True:
+            i = self.hand
+            self.hand = (self.hand + 1) & self.mask
+            if not self.keys[i]:
+                continue
+            if self.used[i]:
+                self.used[i] = 0
+                continue
+            self.delete(i)
+            return
+
+    def delete(self, i):
+        # Backward-shift deletion: pull later entries of the probe run back
+        # into the hole, so lookups never need tombstones.
+        self.keys[i] = 0
+        self.count -= 1
+        j = i
+        while True:
+            j = (j + 1) & self.mask
+            if not self.keys[j]:
+                return
+            home = self.keys[j] & self.mask
+            # Leave the entry alone if its home slot lies cyclically in (i, j].
+            if (i < j and i < home <= j) or (j < i and (home > i or home <= j)):
+                continue
+            self.keys[i], self.moves[i], self.used[i] = self.keys[j], self.moves[j], self.used[j]
+            self.keys[j] = 0
+            i = j
+
+    def __len__(self):
+        return self.count
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+## Copyright (C) 2023, Nicholas Carlini <nicholas@carlini.com>.
+##
+## This program is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Fills the move cache with the model's opening tree ahead of time.
+#
+# Starting from the initial position, every position down to --depth plies
+# is asked about breadth-first. Each position is followed by the model's own
+# move and the --branching most common replies in a PGN corpus (or, without
+# one, the best by a shallow local search). Every answer is written to the
+# cache as soon as it arrives, so an interrupted crawl can simply be run
+# again: positions already in the cache cost nothing the second time.
+
+import argparse
+import asyncio
+import collections
+import json
+import chess
+import chess.pgn
+import chessllm
+import localsearch
+from scheduler import SPECULATIVE
+
+def read_corpus(path, depth):
+    # How often each move was played after each opening line (as a tuple of
+    # moves), over the first `depth` plies of every game from the start position.
+    counts = collections.defaultdict(collections.Counter)
+    games = 0
+    with open(path) as f:
+        while True:
+            game = chess.pgn.read_game(f)
+            if game is None:
+                break
+            if "FEN" in game.headers or game.errors:
+                continue
+            line = ()
+            for move in game.mainline_moves():
+                if len(line) >= depth:
+                    break
+                counts[line][move] += 1
+                line += (move,)
+            games += 1
+    print("Read", games, "games from", path)
+    return counts
+
+def children(board, line, model_move, branching, corpus):
+    moves = [] if model_move is None else [board.parse_san(model_move)]
+    if corpus is not None:
+        alternatives = [move for move, _ in corpus.get(line, collections.Counter()).most_common()]
+    else:
+        # No hurry here, and a search that always finishes keeps the tree
+        # the same from one run to the next.
+        alternatives = localsearch.ranked_moves(board, time_limit=10)
+    for move in alternatives:
+        if len(moves) >= branching:
+            break
+        if move not in moves:
+            moves.append(move)
+    return moves
+
+async def ask(engine, board, num_tokens, stats):
+    move = engine.cached_move(board)
+    if move is not None:
+        stats["cached"] += 1
+        return move
+    # Live games sharing the cache file (and the rate limit) go first.
+    try:
+        _, moves = await engine.query_moves(board, engine.get_query_pgn(board), num_tokens, priority=SPECULATIVE)
+    except Exception as e:
+        print("Query failed for", board.fen(), repr(e))
+        stats["failed"] += 1
+        return None
+    stats["queried"] += 1
+    if not moves:
+        stats["illegal"] += 1
+        return None
+    return moves[0]
+
+async def crawl(engine, depth, branching, concurrency, corpus=None, num_tokens=None):
+    if num_tokens is None:
+        num_tokens = engine.config['num_lookahead_tokens']
+    slots = asyncio.Semaphore(concurrency)
+    async def visit(board):
+        async with slots:
+            return await ask(engine, board, num_tokens, stats)
+
+    level = [chess.Board()]
+    for ply in range(depth):
+        stats = collections.Counter()
+        answers = await asyncio.gather(*[visit(board) for board in level])
+        print(f"Ply {ply}: {len(level)} positions, {stats['cached']} cached, {stats['queried']} queried,"
+              f" {stats['illegal']} illegal replies, {stats['failed']} failed")
+
+        next_level = []
+        for board, answer in zip(level, answers):
+            for move in children(board, tuple(board.move_stack), answer, branching, corpus):
+                child = board.copy()
+                child.push(move)
+                if child.outcome() is None:
+                    next_level.append(child)
+        level = next_level
+
+def main():
+    parser = argparse.ArgumentParser(description="Precompute the model's opening tree into the move cache.")
+    parser.add_argument("--depth", type=int, default=8, help="Plies to crawl from the start position.")
+    parser.add_argument("--branching", type=int, default=3, help="Moves followed from each position.")
+    parser.add_argument("--concurrency", type=int, default=8, help="Positions being asked about at once.")
+    parser.add_argument("--pgn", default=None, help="Follow the most common moves of the games in this PGN file.")
+    args = parser.parse_args()
+
+    api_key = open("OPENAI_API_KEY").read().strip()
+    config = json.loads(open("config.json").read())
+    engine = chessllm.ChessLLM(api_key, config)
+    corpus = read_corpus(args.pgn, args.depth) if args.pgn else None
+    engine.run(crawl(engine, args.depth, args.branching, args.concurrency, corpus))
+    print("Cache now has", len(engine.cache), "positions")
+
+if __name__ == "__main__":
+    main()
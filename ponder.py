@@ -0,0 +1,105 @@
+## Copyright (C) 2023, Nicholas Carlini <nicholas@carlini.com>.
+##
+## This program is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import localsearch
+from scheduler import SPECULATIVE, on_dispatch
+
+class Ponderer:
+    """
+    Asks the model, while the opponent is thinking, what it would play after
+    each of the opponent's `top_k` most likely replies, so that whichever
+    one they pick is (often) already in the move cache.
+
+    The candidates are the reply the model itself predicted, if it is in the
+    cache, followed by the best replies by a shallow local search. Each
+    speculative query is charged an estimate of its token count, and no more
+    are sent once a game has used up `token_budget` (0 means no limit).
+    They queue behind real moves at the rate limiter and for a slot; a real
+    move only waits for one that has already been sent (see `sent`).
+    Everything here runs on the engine's event loop.
+    """
+    def __init__(self, engine, top_k, token_budget):
+        self.engine = engine
+        self.top_k = top_k
+        self.token_budget = token_budget
+        self.tokens_spent = 0
+        self.tasks = {}
+        self.dispatched = set()
+
+    def new_game(self):
+        self.stop()
+        self.tokens_spent = 0
+
+    def candidates(self, board):
+        moves = []
+        predicted = self.engine.cached_move(board)
+        if predicted is not None:
+            moves.append(board.parse_san(predicted))
+        for move in localsearch.ranked_moves(board):
+            if len(moves) >= self.top_k:
+                break
+            if move not in moves:
+                moves.append(move)
+        return moves[:self.top_k]
+
+    async def start(self, board, num_tokens):
+        # `board` is the position with the opponent to move.
+        if board.outcome() is not None:
+            return
+        for move in self.candidates(board):
+            reply = board.copy()
+            reply.push(move)
+            fen = reply.fen()
+            if fen in self.tasks or reply.outcome() is not None or self.engine.cached_move(reply) is not None:
+                continue
+
+            pgn = self.engine.get_query_pgn(reply)
+            # Roughly four characters to a token.
+            cost = len(pgn) // 4 + num_tokens
+            if self.token_budget and self.tokens_spent + cost > self.token_budget:
+                break
+            self.tokens_spent += cost
+
+            task = asyncio.get_running_loop().create_task(self.speculate(fen, reply, pgn, num_tokens))
+            self.tasks[fen] = task
+            task.add_done_callback(lambda task, fen=fen: self.done(fen, task))
+
+    async def speculate(self, fen, board, pgn, num_tokens):
+        on_dispatch.set(lambda: self.dispatched.add(fen))
+        return await self.engine.request_moves(board, pgn, num_tokens, priority=SPECULATIVE)
+
+    def done(self, fen, task):
+        if self.tasks.get(fen) is task:
+            del self.tasks[fen]
+            self.dispatched.discard(fen)
+        # Failed speculation is nobody's problem; don't let asyncio complain.
+        if not task.cancelled():
+            task.exception()
+
+    def pending(self, fen):
+        return self.tasks.get(fen)
+
+    def sent(self, fen):
+        # Whether the query for `fen` has got past the rate limiter and has
+        # a slot, rather than still waiting behind every real move.
+        return fen in self.dispatched
+
+    def stop(self, keep=None):
+        # Once the opponent has moved, only the query for the position they
+        # actually left us (if any) is still worth waiting for.
+        for fen, task in list(self.tasks.items()):
+            if fen != keep:
+                task.cancel()
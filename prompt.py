@@ -0,0 +1,109 @@
+## Copyright (C) 2023, Nicholas Carlini <nicholas@carlini.com>.
+##
+## This program is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import collections
+import operator
+import threading
+import chess
+from history import history_digest, push_digest, extended_key
+
+# Everything that tells two moves apart, read in C: comparing these is
+# several times faster than chess.Move.__eq__, which is Python code.
+MOVE_KEY = operator.attrgetter("from_square", "to_square", "promotion", "drop")
+
+class Movetext:
+    """The PGN movetext of one game, written the way str(chess.pgn.Game()) writes it."""
+    def __init__(self, root):
+        self.board = root.copy(stack=False)
+        self.moves = []
+        self.keys = []
+        # The history key of the moves so far, as a running hash.
+        self.digest = history_digest(root.fen())
+        self.parts = []
+
+    def push(self, move):
+        if self.board.turn == chess.WHITE:
+            self.parts.append(str(self.board.fullmove_number) + ". ")
+        elif not self.moves:
+            self.parts.append(str(self.board.fullmove_number) + "... ")
+        self.parts.append(self.board.san(move) + " ")
+        self.board.push(move)
+        self.moves.append(move)
+        self.keys.append(MOVE_KEY(move))
+        push_digest(self.digest, move)
+
+    def is_prefix_of(self, move_stack, key=None):
+        # With `key`, the history key of `move_stack`, this only costs the
+        # moves past ours: extending our running hash with them gives `key`
+        # only if our moves are the first ones of `move_stack`. Without
+        # it, every move has to be compared.
+        n = len(self.moves)
+        if n > len(move_stack):
+            return False
+        if n > 0 and MOVE_KEY(move_stack[n-1]) != self.keys[-1]:
+            return False
+        if key is not None:
+            return extended_key(self.digest, move_stack[n:]) == key
+        return list(map(MOVE_KEY, move_stack[:n])) == self.keys
+
+    def text(self):
+        return "".join(self.parts).rstrip()
+
+class PromptBuilder:
+    """
+    Builds PGN movetext incrementally instead of replaying the whole game.
+
+    For every game it has seen, it keeps the movetext written so far, filed
+    under the root position, the number of moves and the last move. A board
+    whose move stack extends one of those games by at most `lookback` moves
+    (i.e. the same game a move or two later) only costs the SAN of the new
+    moves. Anything else is written from scratch and remembered from then
+    on. Up to `max_games` games are kept, least recently used first out.
+    """
+    def __init__(self, max_games=256, lookback=8):
+        self.max_games = max_games
+        self.lookback = lookback
+        self.games = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def key(self, root_fen, moves):
+        return (root_fen, len(moves), moves[-1] if moves else None)
+
+    def find(self, root_fen, move_stack, history_key=None):
+        n = len(move_stack)
+        for k in range(n, max(n-self.lookback, 0)-1, -1):
+            key = (root_fen, k, move_stack[k-1] if k else None)
+            game = self.games.get(key)
+            if game is not None and game.is_prefix_of(move_stack, history_key):
+                del self.games[key]
+                return game
+        return None
+
+    def movetext(self, board, history_key=None):
+        # `history_key` is history.history_key of the board, if the caller
+        # already has it; it makes the cost the same at any game length.
+        root = board.root()
+        root_fen = root.fen()
+        with self.lock:
+            game = self.find(root_fen, board.move_stack, history_key)
+            if game is None:
+                game = Movetext(root)
+            for move in board.move_stack[len(game.moves):]:
+                game.push(move)
+
+            self.games[self.key(root_fen, game.moves)] = game
+            if len(self.games) > self.max_games:
+                self.games.popitem(last=False)
+            return game.text()
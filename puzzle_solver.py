@@ -19,6 +19,7 @@ import io
 import json
 import chessllm
 import csv
+import asyncio
 
 def convert_pgn_to_game(pgn_moves):
     pgn = io.StringIO(pgn_moves)
@@ -27,7 +28,7 @@ def convert_pgn_to_game(pgn_moves):
         return None
     return game
 
-def solve_puzzle(board, solution):
+async def solve_puzzle(board, solution):
     solution = solution.split()
     while True:
         if len(solution) > 0:
@@ -36,7 +37,7 @@ def solve_puzzle(board, solution):
         else:
             break
 
-        guess_next_move = engine.get_best_move(board)
+        guess_next_move = await engine.get_best_move_async(board)
 
         real_next_move, *solution = solution
         if guess_next_move != real_next_move:
@@ -51,15 +52,21 @@ def solve_puzzle(board, solution):
         board.push_san(guess_next_move)
     return True
 
+async def solve_all(puzzles):
+    # The engine's scheduler caps how many requests are actually in flight.
+    return await asyncio.gather(*[solve_puzzle(board, solution) for _, board, solution in puzzles])
+
 def main():
 
     ok = [[] for _ in range(30)]
+    counts = [0 for _ in range(30)]
+    puzzles = []
     
     with open("pgn_puzzles.csv", 'r') as f:
         reader = csv.reader(f)
         for puzzleid, rating, pgn, solution in list(reader):
             rating = int(rating)//200
-            if len(ok[rating]) >= 20: continue
+            if counts[rating] >= 20: continue
             
             board = chess.Board()
 
@@ -67,9 +74,11 @@ def main():
             for move in convert_pgn_to_game(pgn).mainline_moves():
                 board.push(move)
 
-            is_right = solve_puzzle(board, solution)
+            puzzles.append((rating, board, solution))
+            counts[rating] += 1
 
-            ok[rating].append(is_right)
+    for (rating, _, _), is_right in zip(puzzles, asyncio.run(solve_all(puzzles))):
+        ok[rating].append(is_right)
     for i,x in enumerate(ok):
         print('rating',i*200, 'acc',np.mean(x))
 
@@ -0,0 +1,146 @@
+## Copyright (C) 2023, Nicholas Carlini <nicholas@carlini.com>.
+##
+## This program is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import os
+import sqlite3
+import threading
+import time
+
+class RateLimiter:
+    """
+    Token buckets for requests and for tokens per minute, shared by every
+    process that opens the same sqlite file (the move cache, normally).
+
+    Each bucket refills at its per-minute rate and holds at most `burst`
+    seconds' worth. A caller that can't go yet joins a queue in the same
+    file and waits its turn instead of failing: the queue is served in order
+    of priority (lower goes first), then arrival. Waiters refresh their place
+    every poll, so a process that dies leaves the queue within a few seconds.
+    A limit of 0 means that bucket is unlimited.
+    """
+    def __init__(self, path, rpm, tpm, burst=1, poll=0.02, timeout=30):
+        # Providers enforce their per-minute limits over much shorter
+        # windows than a minute, so by default there is very little burst.
+        self.rates = {'requests': rpm / 60, 'tokens': tpm / 60}
+        self.capacity = {name: max(1, rate * burst) for name, rate in self.rates.items()}
+        self.poll = poll
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=timeout, isolation_level=None,
+                                    check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS buckets (name TEXT PRIMARY KEY, level REAL NOT NULL, updated REAL NOT NULL)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS waiters (id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                          "priority REAL NOT NULL, pid INTEGER NOT NULL, expires REAL NOT NULL)")
+
+        self.acquired = 0
+        self.waiting = 0
+        self.wait_time = 0.0
+        self.rate_limited = 0
+
+    def transaction(self, fn, *args):
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                out = fn(*args)
+                self.conn.execute("COMMIT")
+                return out
+            except:
+                self.conn.execute("ROLLBACK")
+                raise
+
+    def levels(self, now):
+        # Refill the buckets up to `now` and return their levels.
+        out = {}
+        for name, rate in self.rates.items():
+            row = self.conn.execute("SELECT level, updated FROM buckets WHERE name = ?", (name,)).fetchone()
+            level = self.capacity[name] if row is None else min(self.capacity[name], row[0] + rate * (now - row[1]))
+            self.conn.execute("INSERT OR REPLACE INTO buckets VALUES (?, ?, ?)", (name, level, now))
+            out[name] = level
+        return out
+
+    def enqueue(self, priority):
+        cursor = self.conn.execute("INSERT INTO waiters (priority, pid, expires) VALUES (?, ?, ?)",
+                                   (priority, os.getpid(), time.time() + 1 + 10 * self.poll))
+        return cursor.lastrowid
+
+    def try_acquire(self, waiter, cost):
+        # Returns 0 if we may go now, or else how long to sleep before asking again.
+        now = time.time()
+        self.conn.execute("DELETE FROM waiters WHERE expires < ?", (now,))
+        self.conn.execute("UPDATE waiters SET expires = ? WHERE id = ?", (now + 1 + 10 * self.poll, waiter))
+        head = self.conn.execute("SELECT id FROM waiters ORDER BY priority, id LIMIT 1").fetchone()
+        if head is None or head[0] != waiter:
+            return self.poll
+
+        levels = self.levels(now)
+        wait = 0
+        for name, rate in self.rates.items():
+            if rate > 0 and levels[name] < cost[name]:
+                wait = max(wait, (cost[name] - levels[name]) / rate)
+        if wait > 0:
+            return max(self.poll, wait)
+        for name, rate in self.rates.items():
+            if rate > 0:
+                self.conn.execute("UPDATE buckets SET level = level - ? WHERE name = ?", (cost[name], name))
+        self.conn.execute("DELETE FROM waiters WHERE id = ?", (waiter,))
+        return 0
+
+    async def acquire(self, tokens, priority=0):
+        # A request bigger than the bucket could never go; let it through
+        # once the bucket is full instead.
+        cost = {'requests': 1, 'tokens': min(tokens, self.capacity['tokens'])}
+        start = time.monotonic()
+        self.waiting += 1
+        waiter = self.transaction(self.enqueue, priority)
+        try:
+            while True:
+                wait = self.transaction(self.try_acquire, waiter, cost)
+                if wait == 0:
+                    waiter = None
+                    break
+                await asyncio.sleep(min(wait, 10 * self.poll))
+        finally:
+            self.waiting -= 1
+            if waiter is not None:
+                self.transaction(self.conn.execute, "DELETE FROM waiters WHERE id = ?", (waiter,))
+        self.acquired += 1
+        self.wait_time += time.monotonic() - start
+
+    def backoff(self, retry_after):
+        # The server said no anyway (someone else shares the key, or our
+        # limits are set too high): nobody goes for `retry_after` seconds.
+        self.rate_limited += 1
+        def drain():
+            now = time.time()
+            for name, rate in self.rates.items():
+                self.conn.execute("INSERT OR REPLACE INTO buckets VALUES (?, ?, ?)", (name, -rate * retry_after, now))
+        self.transaction(drain)
+
+    def queue_depth(self):
+        # Everyone waiting, in every process.
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM waiters WHERE expires >= ?", (time.time(),)).fetchone()[0]
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+    def stats(self):
+        return {"queue_depth": self.queue_depth(),
+                "waiting_here": self.waiting,
+                "acquired": self.acquired,
+                "mean_wait": self.wait_time / self.acquired if self.acquired else 0.0,
+                "rate_limited": self.rate_limited}
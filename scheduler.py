@@ -0,0 +1,77 @@
+## Copyright (C) 2023, Nicholas Carlini <nicholas@carlini.com>.
+##
+## This program is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import contextlib
+import contextvars
+import heapq
+import itertools
+
+# Request priorities are the seconds left on the requesting game's clock:
+# lower goes first. Moves without a clock come after any game on the clock,
+# and speculative (pondering) requests after everything else.
+NO_CLOCK = 1e7
+SPECULATIVE = 1e8
+
+# Called (with no arguments) whenever a request made in this context gets a
+# slot, i.e. is about to be sent. Ponderer uses it to tell a speculative
+# query that is on its way from one still waiting in line.
+on_dispatch = contextvars.ContextVar('on_dispatch', default=None)
+
+class RequestScheduler:
+    """
+    Caps the number of completion requests in flight at once. Everyone else
+    waits for a free slot, lowest `priority` first and in order of arrival
+    among equals.
+    """
+    def __init__(self, max_in_flight):
+        self.max_in_flight = max_in_flight
+        self.in_flight = 0
+        self.queue = []
+        self.counter = itertools.count()
+
+    @property
+    def waiting(self):
+        return sum(not future.done() for _, _, future in self.queue)
+
+    def dispatch(self):
+        while self.queue and self.in_flight < self.max_in_flight:
+            _, _, future = heapq.heappop(self.queue)
+            # Waiters that gave up leave their (cancelled) future behind.
+            if not future.done():
+                self.in_flight += 1
+                future.set_result(None)
+
+    @contextlib.asynccontextmanager
+    async def slot(self, priority=NO_CLOCK):
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.queue, (priority, next(self.counter), future))
+        self.dispatch()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # We were handed the slot just as we were cancelled.
+                self.in_flight -= 1
+                self.dispatch()
+            raise
+        callback = on_dispatch.get()
+        if callback is not None:
+            callback()
+        try:
+            yield
+        finally:
+            self.in_flight -= 1
+            self.dispatch()
@@ -0,0 +1,70 @@
+## Copyright (C) 2023, Nicholas Carlini <nicholas@carlini.com>.
+##
+## This program is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+
+class SingleFlight:
+    """
+    Makes sure only one query per game history (see history.history_key)
+    is in flight at a time.
+
+    Within a process, callers asking about a game that is already being
+    queried simply wait for that query's answer. Across processes sharing
+    the move cache, the first one to ask takes a claim on the game in
+    the cache file; the others poll the cache until the claim goes away,
+    then take the answer from the cache (or, if the query failed, try
+    themselves). A claim expires after `ttl` seconds in case its owner
+    died without releasing it.
+    """
+    def __init__(self, cache, ttl, poll=0.02):
+        self.cache = cache
+        self.ttl = ttl
+        self.poll = poll
+        self.tasks = {}
+        self.joined = 0
+        self.waited = 0
+
+    async def run(self, key, fetch):
+        # `fetch()` returns a coroutine giving (text, moves) for `key`.
+        task = self.tasks.get(key)
+        if task is None:
+            task = asyncio.get_running_loop().create_task(self.lead_or_follow(key, fetch))
+            self.tasks[key] = task
+            task.add_done_callback(lambda task: self.tasks.pop(key, None))
+        else:
+            self.joined += 1
+        # One caller running out of time mustn't cancel everyone's query.
+        return await asyncio.shield(task)
+
+    async def lead_or_follow(self, key, fetch):
+        claim = key.hex()
+        while True:
+            if self.cache.claim(claim, self.ttl):
+                try:
+                    text, moves = await fetch()
+                    # When streaming, the full line is only stored once the
+                    # stream ends. Followers just need the first move now.
+                    if moves and self.cache.get_reply(key) is None:
+                        self.cache.update_replies({key: moves[0]})
+                    return text, moves
+                finally:
+                    self.cache.release(claim)
+
+            self.waited += 1
+            while self.cache.claimed(claim):
+                await asyncio.sleep(self.poll)
+            move = self.cache.get_reply(key)
+            if move is not None:
+                return move, [move]
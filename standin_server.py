@@ -0,0 +1,279 @@
+#!/usr/bin/env python3
+
+## Copyright (C) 2023, Nicholas Carlini <nicholas@carlini.com>.
+##
+## This program is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# An offline stand-in for the completions endpoint, for benchmarking and
+# load testing without spending tokens. Start it and set
+# "backend": "local" in config.json:
+#
+#     ./standin_server.py --port 8080 --latency-ms 300 --jitter-ms 100
+#
+# Completions come from a deterministic policy: the prompt is parsed as a
+# PGN and the game is continued with a move picked by hashing the position,
+# written out the way the model writes it (" e5 2. Nf3 Nc6 ..."), with
+# made-up log probabilities for the other legal moves when asked (and, with
+# "echo", for the last move of the prompt itself). With --cassette,
+# recorded completions are served instead, and the policy only answers
+# prompts that aren't in the cassette. With --rpm/--tpm it also enforces
+# rate limits the way the real API does, answering 429 with a Retry-After
+# header.
+
+import argparse
+import collections
+import io
+import json
+import math
+import random
+import threading
+import time
+import chess
+import chess.pgn
+import chess.polyglot
+from cassette import Cassette
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+def policy_move(board):
+    moves = sorted(board.legal_moves, key=lambda move: move.uci())
+    return random.Random(chess.polyglot.zobrist_hash(board)).choice(moves)
+
+def policy_probabilities(board):
+    # policy_move first, the rest in a random order, each half as likely as the one before.
+    moves = sorted(board.legal_moves, key=lambda move: move.uci())
+    rng = random.Random(chess.polyglot.zobrist_hash(board))
+    first = rng.choice(moves)
+    moves.remove(first)
+    rng.shuffle(moves)
+    weights = [0.5 ** i for i in range(len(moves) + 1)]
+    return {move: weight / sum(weights) for move, weight in zip([first] + moves, weights)}
+
+def move_steps(board, move):
+    # The tokens of `move`, each with the log probability of every token
+    # that could have come instead (including itself).
+    by_first = collections.defaultdict(dict)
+    for other, probability in policy_probabilities(board).items():
+        san = board.san(other)
+        by_first[" "+san[:1]][san[1:]] = probability
+    san = board.san(move)
+    first, rest = " "+san[:1], san[1:]
+    steps = [(first, {token: math.log(sum(rests.values())) for token, rests in by_first.items()})]
+    if rest:
+        total = sum(by_first[first].values())
+        steps.append((rest, {token: math.log(p / total) for token, p in by_first[first].items() if token}))
+    return steps
+
+def sample_move(board, temperature, rng):
+    moves, probabilities = zip(*policy_probabilities(board).items())
+    return rng.choices(moves, [p ** (1 / temperature) for p in probabilities])[0]
+
+def policy_steps(prompt, num_tokens, temperature=0, rng=None):
+    """
+    Continue the game in `prompt`, split into roughly model-sized tokens, as
+    (token, alternatives) pairs where `alternatives` has the log probability
+    of each token that might have come there. Above temperature 0, moves
+    are drawn from policy_probabilities instead.
+    """
+    game = chess.pgn.read_game(io.StringIO(prompt))
+    board = game.end().board() if game is not None else chess.Board()
+
+    steps = []
+    while len(steps) < num_tokens and board.outcome() is None:
+        # The prompt already ends with the move number when it's white's turn.
+        if board.turn == chess.WHITE and steps:
+            steps += [(f" {board.fullmove_number}", {f" {board.fullmove_number}": 0.0}), (".", {".": 0.0})]
+        move = sample_move(board, temperature, rng) if temperature > 0 else policy_move(board)
+        steps += move_steps(board, move)
+        board.push(move)
+    return steps[:num_tokens]
+
+def policy_tokens(prompt, num_tokens):
+    return [token for token, _ in policy_steps(prompt, num_tokens)]
+
+def echo_steps(prompt):
+    # The prompt itself as steps, for "echo": everything up to its last
+    # move is one token of unknown probability, and the last move is scored
+    # by the policy. Prompts that don't end in a move are all one token.
+    game = chess.pgn.read_game(io.StringIO(prompt))
+    last = game.end() if game is not None else None
+    if last is None or last.parent is None:
+        return [(prompt, None)]
+    start = prompt.rstrip().rindex(" " + last.san())
+    steps = [(prompt[:start], None)] if start else []
+    steps += move_steps(last.parent.board(), last.move)
+    end = len(prompt.rstrip())
+    return steps + [(prompt[end:], None)] if end < len(prompt) else steps
+
+def logprobs(steps, top_k):
+    # In the shape of the API's `logprobs` field.
+    offsets = [0]
+    for token, _ in steps:
+        offsets.append(offsets[-1] + len(token))
+    return {"tokens": [token for token, _ in steps],
+            "token_logprobs": [alternatives and alternatives[token] for token, alternatives in steps],
+            "top_logprobs": [alternatives and dict(sorted(alternatives.items(), key=lambda item: -item[1])[:top_k])
+                             for _, alternatives in steps],
+            "text_offset": offsets[:-1]}
+
+def split_tokens(text):
+    # Recorded completions are stored as plain text; stream them a word at a time.
+    words = text.split(" ")
+    return [words[0]] + [" "+word for word in words[1:]] if text else []
+
+class Limits:
+    # Per-second token buckets, like the API's own (which don't allow a
+    # whole minute's worth of requests at once).
+    def __init__(self, rpm, tpm):
+        self.rates = {'requests': rpm / 60, 'tokens': tpm / 60}
+        self.levels = {name: max(1, rate) for name, rate in self.rates.items()}
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+        self.rejected = 0
+
+    def admit(self, tokens):
+        # Returns 0 if the request may go, or else the seconds to wait.
+        cost = {'requests': 1, 'tokens': tokens}
+        with self.lock:
+            now = time.monotonic()
+            for name, rate in self.rates.items():
+                self.levels[name] = min(max(1, rate), self.levels[name] + rate * (now - self.updated))
+            self.updated = now
+            wait = max([(min(cost[name], max(1, rate)) - self.levels[name]) / rate
+                        for name, rate in self.rates.items() if rate > 0] + [0])
+            if wait > 0:
+                self.rejected += 1
+                return wait
+            for name in self.rates:
+                self.levels[name] -= cost[name]
+            return 0
+
+class StandinServer:
+    def __init__(self, latency, jitter, token_latency, seed=None, cassette=None, limits=None):
+        self.cassette = cassette
+        self.latency = latency
+        self.jitter = jitter
+        self.token_latency = token_latency
+        self.limits = limits
+        self.random = random.Random(seed)
+
+    def delay(self):
+        time.sleep(max(0, self.latency + self.random.uniform(-self.jitter, self.jitter)))
+
+    def steps(self, data, prompt):
+        num_tokens = data.get('max_tokens', 16)
+        if self.cassette is not None:
+            key = Cassette.key(data.get('model'), data.get('temperature'), num_tokens, prompt)
+            completion = self.cassette.get(key)
+            if completion is not None:
+                # A recording has no alternatives; every token was certain.
+                return [(token, {token: 0.0}) for token in split_tokens(completion)]
+        return policy_steps(prompt, num_tokens, data.get('temperature') or 0, self.random)
+
+    def tokens(self, data, prompt):
+        return [token for token, _ in self.steps(data, prompt)]
+
+def make_handler(server):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_HEAD(self):
+            self.send_response(200)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        def do_POST(self):
+            data = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+            prompts = data['prompt'] if isinstance(data['prompt'], list) else [data['prompt']]
+            num_tokens = data.get('max_tokens', 16)
+
+            if server.limits is not None:
+                wait = server.limits.admit(sum(len(p) // 4 + num_tokens for p in prompts))
+                if wait > 0:
+                    return self.reply(429, {"error": {"message": "Rate limit reached", "type": "requests",
+                                                      "code": "rate_limit_exceeded"}},
+                                      {"Retry-After": str(math.ceil(wait)),
+                                       "retry-after-ms": str(math.ceil(wait * 1000))})
+
+            server.delay()
+            if data.get('stream'):
+                return self.stream(server.tokens(data, prompts[0]))
+
+            choices = []
+            completion_tokens = 0
+            for i, prompt in enumerate(prompts):
+                steps = server.steps(data, prompt) if num_tokens else []
+                completion_tokens += len(steps)
+                if data.get('echo'):
+                    steps = echo_steps(prompt) + steps
+                choices.append({"text": "".join(token for token, _ in steps), "index": i, "finish_reason": "length"})
+                if data.get('logprobs') is not None:
+                    choices[-1]["logprobs"] = logprobs(steps, data['logprobs'])
+            time.sleep(server.token_latency * num_tokens)
+            self.reply(200, {"object": "text_completion",
+                             "model": data.get('model'),
+                             "choices": choices,
+                             "usage": {"prompt_tokens": sum(len(p) // 4 for p in prompts),
+                                       "completion_tokens": completion_tokens}})
+
+        def stream(self, tokens):
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            for token in tokens:
+                time.sleep(server.token_latency)
+                self.chunk(b"data: " + json.dumps({"choices": [{"text": token, "index": 0}]}).encode() + b"\n\n")
+            self.chunk(b"data: [DONE]\n\n")
+            self.chunk(b"")
+
+        def chunk(self, data):
+            self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+            self.wfile.flush()
+
+        def reply(self, status, body, headers={}):
+            body = json.dumps(body).encode()
+            self.send_response(status)
+            for key, value in headers.items():
+                self.send_header(key, value)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline stand-in for the completions endpoint.")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--latency-ms", type=float, default=0, help="Time before the first token.")
+    parser.add_argument("--jitter-ms", type=float, default=0, help="Uniform +/- noise on the latency.")
+    parser.add_argument("--token-ms", type=float, default=0, help="Time per generated token.")
+    parser.add_argument("--seed", type=int, default=None, help="Seed for the jitter.")
+    parser.add_argument("--cassette", default=None, help="Serve completions recorded in this cassette.")
+    parser.add_argument("--rpm", type=float, default=0, help="Requests per minute before answering 429 (0: no limit).")
+    parser.add_argument("--tpm", type=float, default=0, help="Tokens per minute before answering 429 (0: no limit).")
+    args = parser.parse_args()
+
+    cassette = Cassette(args.cassette) if args.cassette else None
+    limits = Limits(args.rpm, args.tpm) if args.rpm or args.tpm else None
+    server = StandinServer(args.latency_ms / 1000, args.jitter_ms / 1000, args.token_ms / 1000, args.seed,
+                           cassette, limits)
+    print(f"Serving stand-in completions on port {args.port}")
+    ThreadingHTTPServer(("127.0.0.1", args.port), make_handler(server)).serve_forever()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+## Copyright (C) 2023, Nicholas Carlini <nicholas@carlini.com>.
+##
+## This program is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Fixtures that run the engine against standin_server.py, so the tests
+# need no API key and no network.
+
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+import pytest
+
+HERE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, HERE)
+
+from chessllm import ChessLLM
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+@pytest.fixture
+def standin():
+    # standin(*args) starts a server with those command line arguments and
+    # returns its completions URL.
+    servers = []
+    def start(*args):
+        port = free_port()
+        server = subprocess.Popen([sys.executable, os.path.join(HERE, "standin_server.py"), "--port", str(port), *args],
+                                  cwd=HERE, stdout=subprocess.DEVNULL)
+        servers.append(server)
+        deadline = time.monotonic() + 10
+        while True:
+            try:
+                socket.create_connection(("127.0.0.1", port), timeout=1).close()
+                break
+            except OSError:
+                if server.poll() is not None or time.monotonic() > deadline:
+                    raise RuntimeError("The stand-in server didn't start")
+                time.sleep(0.05)
+        return f"http://127.0.0.1:{port}/v1/completions"
+    yield start
+    for server in servers:
+        server.terminate()
+        server.wait()
+
+@pytest.fixture
+def engine(tmp_path):
+    # engine(url, **config) makes a ChessLLM using the stand-in at `url`,
+    # with its cache in a fresh temporary directory.
+    engines = []
+    def make(url, **override):
+        with open(os.path.join(HERE, "config.json")) as f:
+            config = json.load(f)
+        config.update(backend="local", local_url=url, cache_path=str(tmp_path / "cache.db"), ponder_moves=0)
+        engines.append(ChessLLM(None, config, **override))
+        return engines[-1]
+    yield make
+    for e in engines:
+        e.close()
@@ -0,0 +1,76 @@
+## Copyright (C) 2023, Nicholas Carlini <nicholas@carlini.com>.
+##
+## This program is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import random
+import chess
+import chess.pgn
+from history import history_key
+
+HEADER = """[White "Magnus Carlsen"]\n[Black "Garry Kasparov"]\n[WhiteElo "2900"]\n[BlackElo "2800"]\n\n"""
+
+def replayed_query_pgn(board):
+    # get_query_pgn as it was before the prompt builder, replaying the game.
+    pgn = str(chess.pgn.Game().from_board(board))[:-1].strip()
+    if board.turn == chess.WHITE:
+        if board.fullmove_number == 1:
+            pgn = pgn + "\n\n1."
+        else:
+            pgn += ' '+str(board.fullmove_number)+"."
+    return HEADER + pgn.split("\n\n")[1]
+
+def random_game(plies, seed, board=None):
+    rng = random.Random(seed)
+    board = chess.Board() if board is None else board
+    for _ in range(plies):
+        if board.outcome() is not None:
+            break
+        board.push(rng.choice(sorted(board.legal_moves, key=lambda move: move.uci())))
+    return board
+
+def prefixes(board):
+    replay = chess.Board(board.root().fen())
+    for move in board.move_stack:
+        replay.push(move)
+        if replay.outcome() is None:
+            yield replay.copy()
+
+def test_matches_the_replayed_pgn(engine):
+    # No requests are made, so any URL will do.
+    e = engine("http://127.0.0.1:1/v1/completions")
+    games = [random_game(80, seed) for seed in range(4)]
+    games.append(random_game(40, 4, chess.Board("r1bqkbnr/pppp1ppp/2n5/4p3/4P3/5N2/PPPP1PPP/RNBQKB1R w KQkq - 2 3")))
+    games.append(random_game(40, 5, chess.Board("8/8/8/4k3/8/8/4P3/4K3 b - - 0 1")))
+    # Several games at once, as in concurrent lichess-bot games.
+    for boards in zip(*[prefixes(game) for game in games]):
+        for board in boards:
+            expected = replayed_query_pgn(board)
+            assert e.get_query_pgn(board) == expected
+            assert e.get_query_pgn(board, history_key(board.root().fen(), board.move_stack)) == expected
+
+def test_transpositions_keep_their_own_history(engine):
+    e = engine("http://127.0.0.1:1/v1/completions")
+    one, other = chess.Board(), chess.Board()
+    for move in ["Nf3", "Nf6", "g3", "g6"]:
+        one.push_san(move)
+    for move in ["g3", "g6", "Nf3", "Nf6"]:
+        other.push_san(move)
+    assert one.board_fen() == other.board_fen()
+    for board in [one, other, one, other]:
+        assert e.get_query_pgn(board) == replayed_query_pgn(board)
+    assert e.get_query_pgn(one) != e.get_query_pgn(other)
+
+def test_the_first_move(engine):
+    e = engine("http://127.0.0.1:1/v1/completions")
+    assert e.get_query_pgn(chess.Board()) == HEADER + "1."
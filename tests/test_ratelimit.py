@@ -0,0 +1,49 @@
+## Copyright (C) 2023, Nicholas Carlini <nicholas@carlini.com>.
+##
+## This program is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import chess
+
+OPENINGS = ["e4", "d4", "c4", "Nf3", "g3", "b3"]
+
+def ask_all(e):
+    # The model's reply to each opening, all asked at once.
+    async def ask():
+        boards = []
+        for opening in OPENINGS:
+            board = chess.Board()
+            board.push_san(opening)
+            boards.append(board)
+        return await asyncio.gather(*[e.get_best_move_async(board) for board in boards])
+    return asyncio.run(ask())
+
+def test_backs_off_when_the_server_says_429(standin, engine):
+    # Our own limit is far above the server's, so it answers 429 and every
+    # request still gets through after waiting out its Retry-After.
+    e = engine(standin("--rpm", "120"), rate_limit_rpm=60000)
+    assert all(move is not None for move in ask_all(e))
+    stats = e.connection_stats()
+    assert stats["rate_limited"] >= 1
+    assert stats["acquired"] >= len(OPENINGS)
+
+def test_queues_under_its_own_limit(standin, engine):
+    # Under the server's limit requests wait their turn instead of failing.
+    e = engine(standin("--rpm", "600"), rate_limit_rpm=300)
+    assert all(move is not None for move in ask_all(e))
+    stats = e.connection_stats()
+    assert stats["rate_limited"] == 0
+    assert stats["acquired"] == len(OPENINGS)
+    assert stats["mean_wait"] > 0
+    assert stats["queue_depth"] == 0
@@ -0,0 +1,44 @@
+## Copyright (C) 2023, Nicholas Carlini <nicholas@carlini.com>.
+##
+## This program is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import math
+import chess
+import pytest
+from standin_server import policy_probabilities
+
+def ranking(board):
+    probabilities = policy_probabilities(board)
+    return [(board.san(move), math.log(p)) for move, p in
+            sorted(probabilities.items(), key=lambda item: -item[1])]
+
+@pytest.mark.parametrize("moves", [[], ["e4"], ["e4", "e5", "Nf3", "Nc6", "Bb5"], ["d4", "d5", "c4", "e6", "Nc3", "Nf6"]])
+def test_scores_follow_the_policy(standin, engine, moves):
+    e = engine(standin())
+    board = chess.Board()
+    for move in moves:
+        board.push_san(move)
+    scores = e.get_move_scores(board)
+    expected = ranking(board)
+    assert [san for san, _ in scores] == [san for san, _ in expected]
+    for (_, score), (_, logprob) in zip(scores, expected):
+        assert score == pytest.approx(logprob, abs=1e-4)
+
+def test_batches_cover_every_legal_move(standin, engine):
+    # Fewer prompts to a request than legal moves.
+    e = engine(standin(), max_batch_size=4)
+    board = chess.Board()
+    scores = e.get_move_scores(board)
+    assert sorted(san for san, _ in scores) == sorted(board.san(move) for move in board.legal_moves)
+    assert scores[0][0] == ranking(board)[0][0]
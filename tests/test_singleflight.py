@@ -0,0 +1,41 @@
+## Copyright (C) 2023, Nicholas Carlini <nicholas@carlini.com>.
+##
+## This program is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import chess
+
+def ask(engines, board):
+    async def run():
+        return await asyncio.gather(*[e.get_best_move_async(board) for e in engines])
+    return asyncio.run(run())
+
+def test_one_engine_asks_once(standin, engine):
+    e = engine(standin("--latency-ms", "200"))
+    board = chess.Board()
+    board.push_san("e4")
+    moves = ask([e] * 3, board)
+    assert moves[0] is not None and moves == [moves[0]] * 3
+    assert e.singleflight.joined == 2
+    assert e.backend.stats()["requests"] == 2  # the pre-warm and one completion
+
+def test_engines_sharing_a_cache_ask_once(standin, engine):
+    url = standin("--latency-ms", "200")
+    first, second = engine(url), engine(url)
+    board = chess.Board()
+    board.push_san("d4")
+    moves = ask([first, second], board)
+    assert moves[0] is not None and moves[0] == moves[1]
+    assert first.singleflight.waited + second.singleflight.waited == 1
+    assert first.backend.stats()["requests"] + second.backend.stats()["requests"] == 3
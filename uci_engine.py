@@ -16,13 +16,65 @@
 ## along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import chess
+import chess.pgn
 from chessllm import ChessLLM
 import json
+import random
+
+def go_params(go):
+    # The times in a "go" command, in seconds.
+    words = go.split()
+    return {k: int(v) / 1000 for k, v in zip(words[1:], words[2:]) if v.lstrip("-").isdigit()}
+
+def time_budget(board, go):
+    # How long to wait for the model, from the clock in a "go" command.
+    params = go_params(go)
+    if "movetime" in params:
+        return params["movetime"]
+    my_time, my_inc = ("wtime", "winc") if board.turn == chess.WHITE else ("btime", "binc")
+    if my_time not in params:
+        return None
+    return min(params[my_time] / 30 + params.get(my_inc, 0), params[my_time] / 2)
+
+def clock(board, go):
+    params = go_params(go)
+    return params.get("wtime" if board.turn == chess.WHITE else "btime", params.get("movetime"))
+
+def go(board, line):
+    log.write("info string Starting search\n")
+    log.flush()
+
+    move = engine.get_best_move(board, time_budget=time_budget(board, line), clock=clock(board, line))
+    try:
+        log.write("Have move " + move + "\n")
+        uci_move = board.push_san(move).uci()
+    except:
+        log.write(f"info string Invalid move: {repr(move)}\n")
+        log.flush()
+
+        moves = list(board.legal_moves)
+        move = random.choice(moves)
+        board.push(move)
+        uci_move = move.uci()
+
+    # The model usually predicted the opponent's reply too; offer it as
+    # the move to ponder on.
+    predicted = engine.cached_move(board)
+    board.pop()
+
+    print(f"info pv {uci_move}")
+    if predicted:
+        after = board.copy()
+        after.push_uci(uci_move)
+        print(f"bestmove {uci_move} ponder {after.parse_san(predicted).uci()}")
+    else:
+        print(f"bestmove {uci_move}")
 
 def main():
 
     config = json.loads(open("config.json").read())
     game = chess.pgn.Game()
+    pondering = None
 
     while True:
         line = input()
@@ -31,6 +83,7 @@ def main():
         if line == "uci":
             print(f"id name chess-llm-with-{config['model']}")
             print("id author Nicholas Carlini")
+            print("option name Ponder type check default false")
             print("uciok")
         elif line == "isready":
             print("readyok")
@@ -54,24 +107,30 @@ def main():
             log.flush()
 
 
-        elif line.startswith("go"):
-            log.write("info string Starting search\n")
+        elif line.startswith("go") and "ponder" in line.split():
+            # The GUI has played our predicted reply for the opponent; use
+            # their thinking time to ask about the other likely replies too.
+            log.write("info string Pondering\n")
             log.flush()
-
-            move = engine.get_best_move(board)
-            try:
-                log.write("Have move " + move + "\n")
-                uci_move = board.push_san(move).uci()
-            except:
-                log.write(f"info string Invalid move: {repr(move)}\n")
-                log.flush()
-                
-                moves = list(board.legal_moves)
-                move = random.choice(moves)
-                uci_move = move.uci()
-            
-            print(f"info pv {uci_move}")
-            print(f"bestmove {uci_move}")
+            pondering = line
+            if board.move_stack:
+                before = board.copy()
+                before.pop()
+                engine.ponder(before)
+        elif line == "ponderhit":
+            go(board, pondering)
+            pondering = None
+        elif line == "stop":
+            if pondering:
+                # The opponent didn't play the ponder move. The GUI ignores
+                # this bestmove, so don't spend anything on it.
+                pondering = None
+                move = engine.fallback_move(board)
+                print(f"bestmove {board.parse_san(move).uci()}" if move else "bestmove 0000")
+        elif line.startswith("go"):
+            go(board, line)
+        elif line == "ucinewgame":
+            engine.new_game()
         elif line == "quit":
             break
 